@@ -56,13 +56,23 @@
         extraModules = [ self.nixosModules.nextcloud ];
       } // args);
     in {
+      doctests = import tests/doctests.nix {
+        pkgs = nixpkgs.legacyPackages.${system};
+      };
+      enable-disable-apps = import tests/enable-disable-apps.nix {
+        pkgs = nixpkgs.legacyPackages.${system};
+      };
       smoke = callTest tests/smoke.nix {};
       talk = callTest tests/talk {
         inherit (nixpkgs-webdriver.legacyPackages.${system})
           geckodriver firefox-unwrapped;
       };
+      talk-stand-in = import tests/talk/stand-in.nix {
+        pkgs = nixpkgs.legacyPackages.${system};
+      };
       urls = callTest tests/urls.nix {};
       upgrade = callTest tests/upgrade.nix {};
+      upgrade-timings = callTest tests/upgrade-timings.nix {};
     });
 
     hydraJobs = {
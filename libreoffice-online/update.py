@@ -4,15 +4,27 @@
 #!nix-shell -p python3Packages.python --argstr # noqa
 #!nix-shell -p nodePackages.node2nix --argstr # noqa
 
+import hashlib
 import json
 import os
 import subprocess
+import sys
 import tempfile
 
-from typing import List, Dict
+from argparse import ArgumentParser
+from typing import Any, Iterable, List, Dict, Optional
 
 BASEDIR = os.path.dirname(os.path.realpath(__file__))
 OUTDIR = os.path.join(BASEDIR, 'node-deps')
+COMPONENTS_DIR = os.path.join(BASEDIR, 'component-deps')
+SHARED_NAME = 'shared'
+FINGERPRINT_FILE = 'fingerprint.json'
+NODE2NIX_FLAGS = ['--nodejs-10']
+SOURCE_EXPR = '((import <nixpkgs> {}).callPackage ./package.nix {}).src'
+
+# The sections of package.json the dependencies are read from.
+LOLEAFLET_SECTIONS = ['devDependencies']
+COMPONENT_SECTIONS = ['dependencies', 'devDependencies']
 
 PACKAGES: Dict[str, str] = {
     'sdkjs': 'sdkjs/build',
@@ -26,40 +38,220 @@ PACKAGES: Dict[str, str] = {
 }
 
 
+def get_source_path() -> str:
+    """
+    Get the store path of the source without building it, which only needs
+    an evaluation and no download.
+    """
+    expr = f'({SOURCE_EXPR}).outPath'
+    cmd = ['nix-instantiate', '--eval', '--json', '-E', expr]
+    result = subprocess.run(cmd, cwd=BASEDIR, capture_output=True, check=True)
+    return json.loads(result.stdout)
+
+
 def get_source() -> str:
-    expr = '((import <nixpkgs> {}).callPackage ./package.nix {}).src'
-    cmd = ['nix-build', '--no-out-link', '-E', expr]
+    cmd = ['nix-build', '--no-out-link', '-E', SOURCE_EXPR]
     result = subprocess.run(cmd, cwd=BASEDIR, capture_output=True, check=True)
     return result.stdout.strip().decode()
 
 
-def get_package_desc(descfile: str) -> List[Dict[str, str]]:
+def get_package_desc(
+    descfile: str, sections: Iterable[str] = ('devDependencies',)
+) -> List[Dict[str, str]]:
     contents = json.load(open(descfile, 'r'))
-    return [{k: v} for k, v in contents['devDependencies'].items()]
+    return [{k: v} for section in sections
+            for k, v in contents.get(section, {}).items()]
+
+
+def get_fingerprint(desc: List[Dict[str, str]]) -> str:
+    """
+    Hash the dependency description along with the node2nix flags, so that
+    changing either of them results in a different fingerprint.
+    """
+    data = json.dumps([desc, NODE2NIX_FLAGS], sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def read_fingerprint(outdir: str) -> Optional[Dict[str, Any]]:
+    outputs = ['node-env.nix', 'node-packages.nix', 'default.nix']
+    if not all(os.path.exists(os.path.join(outdir, fn)) for fn in outputs):
+        return None
+    try:
+        with open(os.path.join(outdir, FINGERPRINT_FILE), 'r') as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return None
+
 
+def write_fingerprint(outdir: str, src: str, fingerprint: str,
+                      config: Dict[str, Any]) -> None:
+    with open(os.path.join(outdir, FINGERPRINT_FILE), 'w') as fp:
+        json.dump({'src': src, 'dependencies': fingerprint,
+                   'flags': NODE2NIX_FLAGS, 'config': config},
+                  fp, indent=2, sort_keys=True)
+        fp.write('\n')
 
-def node2nix(desc: List[Dict[str, str]]) -> None:
-    os.makedirs(OUTDIR, exist_ok=True)
+
+def is_source_unchanged(previous: Optional[Dict[str, Any]],
+                        config: Dict[str, Any]) -> bool:
+    """
+    If neither the source, the flags nor the configuration of what's read
+    from the source changed, the result would be the same as well, so there
+    is no need to even fetch the source.
+
+    The configuration is compared first, since it's cheap to check:
+
+    >>> is_source_unchanged({'flags': NODE2NIX_FLAGS, 'config': {'a': 1}},
+    ...                     {'a': 2})
+    False
+    """
+    return previous is not None and previous.get('flags') == NODE2NIX_FLAGS \
+        and previous.get('config') == config \
+        and previous.get('src') == get_source_path()
+
+
+def node2nix(desc: List[Dict[str, str]], outdir: str) -> None:
+    os.makedirs(outdir, exist_ok=True)
     with tempfile.NamedTemporaryFile('w+') as fp:
         json.dump(desc, fp)
         fp.flush()
         cmd = [
-            'node2nix', '--nodejs-10',
-            '-e', os.path.join(OUTDIR, 'node-env.nix'),
-            '-o', os.path.join(OUTDIR, 'node-packages.nix'),
-            '-c', os.path.join(OUTDIR, 'default.nix'),
+            'node2nix', *NODE2NIX_FLAGS,
+            '-e', os.path.join(outdir, 'node-env.nix'),
+            '-o', os.path.join(outdir, 'node-packages.nix'),
+            '-c', os.path.join(outdir, 'default.nix'),
             '-i', fp.name
         ]
         subprocess.run(cmd, check=True)
 
 
-def update() -> None:
-    src = get_source()
+def regenerate(desc: List[Dict[str, str]], outdir: str, src: str,
+               previous: Optional[Dict[str, Any]],
+               config: Dict[str, Any]) -> None:
+    fingerprint = get_fingerprint(desc)
+    if previous is None or previous.get('dependencies') != fingerprint:
+        node2nix(desc, outdir)
+    else:
+        print('Dependencies unchanged, skipping node2nix.', file=sys.stderr)
+    write_fingerprint(outdir, src, fingerprint, config)
+
+
+def merge_descs(descs: Iterable[List[Dict[str, str]]]) -> List[Dict[str, str]]:
+    """
+    Merge several dependency descriptions into one, keeping only the first
+    occurrence of every package and version specification:
 
+    >>> merge_descs([[{'a': '1'}, {'b': '2'}], [{'b': '2'}, {'a': '3'}]])
+    [{'a': '1'}, {'b': '2'}, {'a': '3'}]
+    >>> merge_descs([[{'a': '1'}, {'a': '1'}]])
+    [{'a': '1'}]
+    """
+    merged: List[Dict[str, str]] = []
+    for desc in descs:
+        for entry in desc:
+            if entry not in merged:
+                merged.append(entry)
+    return merged
+
+
+def get_component_attrs(desc: List[Dict[str, str]]) -> List[str]:
+    """
+    Get the quoted attribute names of the packages in the shared node2nix
+    output for the given dependency description.
+
+    Packages of a collection are named by node2nix after the package name
+    and the version specification, for example "jquery-2.2.4". Since the
+    description of a component contains both dependencies and
+    devDependencies, the same package might occur twice, which would be a
+    duplicate attribute in Nix:
+
+    >>> get_component_attrs([{'a': '1.0'}, {'b': '${x}'}, {'a': '1.0'}])
+    ['"a-1.0"', '"b-\\\\${x}"']
+    """
+    return [json.dumps(f'{k}-{v}').replace('${', '\\${')
+            for entry in merge_descs([desc]) for k, v in entry.items()]
+
+
+def write_component(name: str, desc: List[Dict[str, str]]) -> None:
+    """
+    Write a composition for a single component, which picks the packages of
+    that component from the shared node2nix output.
+    """
+    attrs = get_component_attrs(desc)
+    outdir = os.path.join(COMPONENTS_DIR, name)
+    os.makedirs(outdir, exist_ok=True)
+    with open(os.path.join(outdir, 'default.nix'), 'w') as fp:
+        fp.write('# This file has been generated by update.py. Do not edit!\n'
+                 '\n'
+                 'args:\n'
+                 '\n'
+                 'let\n'
+                 f'  shared = import ../{SHARED_NAME} args;\n'
+                 'in {\n'
+                 '  inherit (shared)\n')
+        fp.write(''.join(f'    {attr}\n' for attr in attrs))
+        fp.write('  ;\n}\n')
+
+
+def update_loleaflet(force: bool = False) -> None:
+    config = {'sections': LOLEAFLET_SECTIONS}
+    previous = None if force else read_fingerprint(OUTDIR)
+    if is_source_unchanged(previous, config):
+        print('Source unchanged, skipping node2nix.', file=sys.stderr)
+        return
+
+    src = get_source()
     path = os.path.join(src, 'loleaflet', 'package.json')
-    desc = get_package_desc(path)
-    node2nix(desc)
+    desc = get_package_desc(path, LOLEAFLET_SECTIONS)
+    regenerate(desc, OUTDIR, src, previous, config)
+
+
+def update_components(force: bool = False) -> None:
+    """
+    Generate the node dependencies of all the components in PACKAGES.
+
+    Instead of running node2nix once per component, all the components are
+    merged into a single collection, so node2nix resolves and prefetches the
+    dependencies shared between components only once and does so for all
+    components at the same time. Every component then gets its own output
+    directory, which only contains the packages of that component.
+    """
+    shared_dir = os.path.join(COMPONENTS_DIR, SHARED_NAME)
+    # Changing the components or what's read of them changes the outputs
+    # even if the source stays the same.
+    config = {'sections': COMPONENT_SECTIONS, 'packages': PACKAGES}
+    previous = None if force else read_fingerprint(shared_dir)
+    if is_source_unchanged(previous, config):
+        print('Source unchanged, skipping node2nix.', file=sys.stderr)
+        return
+
+    src = get_source()
+    descs: Dict[str, List[Dict[str, str]]] = {}
+    for name, subdir in PACKAGES.items():
+        descfile = os.path.join(src, subdir, 'package.json')
+        if not os.path.exists(descfile):
+            print(f'No package.json for {name} in {subdir}, skipping.',
+                  file=sys.stderr)
+            continue
+        descs[name] = get_package_desc(descfile, COMPONENT_SECTIONS)
+
+    regenerate(merge_descs(descs.values()), shared_dir, src, previous,
+               config)
+    for name, desc in descs.items():
+        write_component(name, desc)
 
 
 if __name__ == '__main__':
-    update()
+    parser = ArgumentParser(description='Regenerate the node2nix expressions')
+    parser.add_argument('--force', action='store_true',
+                        help='Run node2nix even if the dependencies did not'
+                        ' change since the last run')
+    parser.add_argument('--all', action='store_true',
+                        help='Generate the dependencies of all components'
+                        f' into {os.path.basename(COMPONENTS_DIR)}/ instead'
+                        ' of only the ones of loleaflet')
+    options = parser.parse_args()
+    if options.all:
+        update_components(options.force)
+    else:
+        update_loleaflet(options.force)
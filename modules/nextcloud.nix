@@ -206,7 +206,9 @@ let
     checkPhase = "${php}/bin/php -l \"$out/config.php\"";
   };
 
-  mkEnableDisableApps = occCmd: disableOnly: let
+  # The current app state is read directly from the database at the given
+  # socket directory, so that occ is only invoked for actual state changes.
+  mkEnableDisableApps = dbHost: occCmd: disableOnly: let
     appPart = lib.partition (a: cfg.apps.${a}.enable) (lib.attrNames cfg.apps);
 
     newState = pkgs.writeText "nextcloud-appstate.json" (builtins.toJSON ({
@@ -217,11 +219,12 @@ let
     }));
 
     enableDisableApps = lib.escapeShellArgs [
-      pkgs.python3Packages.python.interpreter
+      (pkgs.python3.withPackages (p: [ p.psycopg2 ])).interpreter
       "${../tools/enable-disable-apps.py}"
     ];
 
-  in "${enableDisableApps} ${lib.escapeShellArg newState} ${occCmd}";
+  in "${enableDisableApps} --db-host ${dbHost}"
+   + " ${lib.escapeShellArg newState} ${occCmd}";
 
   nextcloudInit = pkgs.runCommand "nextcloud-init" {
     nativeBuildInputs = [
@@ -264,7 +267,8 @@ let
     ${phpCliInit} "$nextcloud/occ" background:cron
     ${phpCliInit} "$nextcloud/occ" db:convert-filecache-bigint
 
-    ${mkEnableDisableApps "${phpCliInit} \"$nextcloud/occ\"" true}
+    ${mkEnableDisableApps "\"$TMPDIR\""
+      "${phpCliInit} \"$nextcloud/occ\"" true}
 
     rm "$PWD/data/index.html" "$PWD/data/.htaccess"
     pg_dump -h "$TMPDIR" nextcloud > "$sql"
@@ -948,11 +952,13 @@ in {
       confinement.packages = [ pkgs.glibcLocales php nextcloudConfigDir ];
 
       script = ''
+        # The verbose output includes the repair steps, so their duration can
+        # be determined from the timestamps in the journal.
         if [ -e /var/lib/nextcloud/.version ]; then
           __NEXTCLOUD_VERSION="$(< /var/lib/nextcloud/.version)" \
-            ${phpCli} ${occ} upgrade
+            ${phpCli} ${occ} upgrade -v
         fi
-        ${mkEnableDisableApps "${phpCli} ${occ}" false}
+        ${mkEnableDisableApps "/run/postgresql" "${phpCli} ${occ}" false}
       '';
 
       serviceConfig = {
@@ -11,8 +11,18 @@ let
     filtered = lib.filterAttrs isValidPackage (builtins.readDir ./.);
   in lib.mapAttrs (name: lib.const (./. + "/${name}")) filtered;
 
+  # The metadata of the apps is shared between all major versions and only
+  # referenced by its key in the upstream.json files.
+  metadata = lib.importJSON ./metadata.json;
+
   releaseInfos = let
-    importReleaseInfo = path: lib.importJSON (path + "/upstream.json");
+    resolveMeta = lib.const (attrs: attrs // lib.optionalAttrs
+      (lib.isString (attrs.meta or null)) { meta = metadata.${attrs.meta}; });
+    importReleaseInfo = path: let
+      info = lib.importJSON (path + "/upstream.json");
+    in info // {
+      applications = lib.mapAttrs resolveMeta (info.applications or {});
+    };
   in lib.mapAttrs (lib.const importReleaseInfo) packages;
 
   inherit (releaseInfos.${toString majorVersion}) nextcloud;
@@ -0,0 +1,21 @@
+# Runs the doctests of scripts that are not part of any Python package and
+# thus wouldn't be tested otherwise.
+{ pkgs, lib ? pkgs.lib }:
+
+let
+  scripts = [
+    ../libreoffice-online/update.py
+    ../tools/enable-disable-apps.py
+  ];
+
+  python = pkgs.python3;
+
+in pkgs.runCommand "doctests" {
+  nativeBuildInputs = [ python ];
+} ''
+  ${lib.concatMapStrings (script: ''
+    echo "running doctests of ${baseNameOf (toString script)}" >&2
+    python3 -m doctest ${lib.escapeShellArg "${script}"}
+  '') scripts}
+  touch "$out"
+''
@@ -0,0 +1,58 @@
+# Runs tools/enable-disable-apps.py against a throwaway PostgreSQL server,
+# so reading the app state via --db-host and psycopg2 is checked without
+# having to boot a VM.
+{ pkgs, lib ? pkgs.lib }:
+
+let
+  python = pkgs.python3.withPackages (p: [ p.psycopg2 ]);
+
+  newState = pkgs.writeText "appstate.json" (builtins.toJSON {
+    enable = { calendar = [ "admin" ]; spreed = null; files = null; };
+    appconf.spreed = {
+      stun_servers = "[\"localhost:3478\"]";
+      turn_servers = "[]";
+    };
+    disable = [ "news" "notinstalled" ];
+  });
+
+  # Only the calls changing state are expected to go through occ.
+  expected = pkgs.writeText "expected-occ-calls" ''
+    app:disable -- news
+    app:enable -- spreed
+    app:enable -g admin calendar
+    config:app:set spreed turn_servers --value=[]
+  '';
+
+  fakeOcc = pkgs.writeScript "fake-occ" ''
+    #!${pkgs.stdenv.shell}
+    echo "$*" >> "$TMPDIR/occ-calls"
+  '';
+
+in pkgs.runCommand "enable-disable-apps" {
+  nativeBuildInputs = [ pkgs.postgresql python ];
+} ''
+  initdb -D "$TMPDIR/db" -U nextcloud --auth=trust > /dev/null
+  pg_ctl -D "$TMPDIR/db" -w -o "-k $TMPDIR -c listen_addresses=" start
+
+  psql -v ON_ERROR_STOP=1 -h "$TMPDIR" -U nextcloud -d postgres \
+    -c 'CREATE DATABASE nextcloud'
+  psql -v ON_ERROR_STOP=1 -h "$TMPDIR" -U nextcloud -d nextcloud <<SQL
+  CREATE TABLE oc_appconfig (
+    appid VARCHAR(32), configkey VARCHAR(64), configvalue TEXT,
+    PRIMARY KEY (appid, configkey)
+  );
+  INSERT INTO oc_appconfig VALUES
+    ('files', 'enabled', 'yes'),
+    ('spreed', 'enabled', 'no'),
+    ('spreed', 'stun_servers', '["localhost:3478"]'),
+    ('news', 'enabled', 'yes');
+  SQL
+
+  touch "$TMPDIR/occ-calls"
+  python3 ${lib.escapeShellArg "${../tools/enable-disable-apps.py}"} \
+    --db-host "$TMPDIR" ${newState} ${fakeOcc}
+  LC_ALL=C sort "$TMPDIR/occ-calls" | diff -u ${expected} -
+
+  pg_ctl -D "$TMPDIR/db" -w stop
+  touch "$out"
+''
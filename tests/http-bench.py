@@ -0,0 +1,201 @@
+import os
+import threading
+import time
+
+from argparse import ArgumentParser
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from requests.auth import HTTPBasicAuth
+
+from loadtools import percentiles, write_report
+
+PROPFIND_BODY = '''<?xml version="1.0"?>
+<d:propfind xmlns:d="DAV:" xmlns:oc="http://owncloud.org/ns">
+  <d:prop>
+    <d:getlastmodified/>
+    <d:getcontentlength/>
+    <d:getetag/>
+    <oc:fileid/>
+    <oc:permissions/>
+  </d:prop>
+</d:propfind>
+'''
+
+Endpoint = namedtuple('Endpoint', ['method', 'path', 'headers', 'data',
+                                   'status'])
+
+OCS_HEADERS = {'OCS-APIREQUEST': 'true'}
+
+
+def make_endpoints(user, folder):
+    dav = f'/remote.php/dav/files/{user}/{folder}'
+    return {
+        'status': Endpoint('GET', '/status.php', {}, None, 200),
+        'well-known-caldav': Endpoint('GET', '/.well-known/caldav', {}, None,
+                                      301),
+        'well-known-carddav': Endpoint('GET', '/.well-known/carddav', {},
+                                       None, 301),
+        'ocs-capabilities': Endpoint(
+            'GET', '/ocs/v2.php/cloud/capabilities?format=json', OCS_HEADERS,
+            None, 200
+        ),
+        'ocm-provider': Endpoint('GET', '/ocm-provider/', {}, None, 200),
+        'ocs-provider': Endpoint('GET', '/ocs-provider/', {}, None, 200),
+        'dav-propfind': Endpoint(
+            'PROPFIND', dav + '/', {'Depth': '1'}, PROPFIND_BODY, 207
+        ),
+        'dav-get': Endpoint('GET', dav + '/file-{num}.bin', {}, None, 200),
+    }
+
+
+class Client:
+    """
+    Runs requests on a fixed set of worker threads, each of which has its own
+    session, since sessions are not guaranteed to be thread-safe but should
+    still keep their connections alive across requests and endpoints.
+    """
+    def __init__(self, url, auth, concurrency, verify=True):
+        self.url = url.rstrip('/')
+        self.auth = auth
+        self.verify = verify
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(concurrency)
+
+    @property
+    def session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.auth = self.auth
+            session.verify = self.verify
+            self.local.session = session
+        return session
+
+    def request(self, method, path, **kwargs):
+        return self.session.request(method, self.url + path,
+                                    allow_redirects=False, **kwargs)
+
+
+def setup_files(client, user, folder, count, size):
+    dav = f'/remote.php/dav/files/{user}/{folder}'
+    client.request('DELETE', dav + '/')
+    client.request('MKCOL', dav + '/').raise_for_status()
+    data = os.urandom(size)
+    for num in range(count):
+        path = f'{dav}/file-{num}.bin'
+        client.request('PUT', path, data=data).raise_for_status()
+
+
+def cleanup_files(client, user, folder):
+    client.request('DELETE', f'/remote.php/dav/files/{user}/{folder}/')
+
+
+def bench_endpoint(client, endpoint, amount, files):
+    def run(num):
+        path = endpoint.path.format(num=num % files if files else 0)
+        start = time.monotonic()
+        try:
+            response = client.request(endpoint.method, path,
+                                      headers=endpoint.headers,
+                                      data=endpoint.data)
+            # Make sure the whole body is transferred and accounted for.
+            response.content
+        except requests.RequestException as e:
+            return None, repr(e)
+        latency = time.monotonic() - start
+        if response.status_code != endpoint.status:
+            return None, f'{endpoint.method} {path}: unexpected status' \
+                         f' {response.status_code}'
+        return latency, None
+
+    start = time.monotonic()
+    results = list(client.executor.map(run, range(amount)))
+    duration = time.monotonic() - start
+
+    latencies = [latency for latency, _ in results if latency is not None]
+    errors = [error for _, error in results if error is not None]
+    result = {
+        'requests': amount,
+        'errors': len(errors),
+        'duration': duration,
+        'throughput': len(latencies) / duration,
+        'latency': percentiles(latencies),
+    }
+    if errors:
+        result['first_error'] = errors[0]
+    return result
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark the latency of Nextcloud'
+                            ' HTTP endpoints under concurrent load')
+    parser.add_argument('--url', default='http://localhost',
+                        help='Base URL of the Nextcloud instance')
+    parser.add_argument('--user', metavar='USER:PASSWORD',
+                        default='admin:admin',
+                        help='Credentials to use for basic auth')
+    parser.add_argument('--insecure', action='store_true',
+                        help='Skip TLS certificate verification')
+    parser.add_argument('--endpoint', action='append', dest='endpoints',
+                        help='Only benchmark the given endpoint, can be'
+                        ' specified multiple times, defaults to all')
+    parser.add_argument('--list', action='store_true',
+                        help='List all available endpoints and exit')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='Number of requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--files', type=int, default=20,
+                        help='Number of test files to create for WebDAV')
+    parser.add_argument('--file-size', type=int, default=64 * 1024)
+    parser.add_argument('--folder', default='http-bench',
+                        help='Folder to create the WebDAV test files in')
+    options = parser.parse_args()
+
+    user, password = options.user.split(':', 1)
+    endpoints = make_endpoints(user, options.folder)
+
+    if options.list:
+        for name, endpoint in endpoints.items():
+            print(f'{name}: {endpoint.method} {endpoint.path}')
+        return
+
+    selected = options.endpoints or list(endpoints)
+    unknown = set(selected) - set(endpoints)
+    if unknown:
+        parser.error(f'Unknown endpoints: {", ".join(sorted(unknown))}')
+
+    client = Client(options.url, HTTPBasicAuth(user, password),
+                    options.concurrency, verify=not options.insecure)
+    needs_files = any(name.startswith('dav-') for name in selected)
+
+    report = {
+        'url': options.url,
+        'concurrency': options.concurrency,
+        'endpoints': {},
+    }
+    if needs_files:
+        setup_files(client, user, options.folder, options.files,
+                    options.file_size)
+    try:
+        for name in selected:
+            report['endpoints'][name] = bench_endpoint(
+                client, endpoints[name], options.requests, options.files
+            )
+    finally:
+        if needs_files:
+            cleanup_files(client, user, options.folder)
+        client.executor.shutdown()
+
+    write_report(report, [
+        f'{name}: {result["errors"]} of {result["requests"]} requests'
+        f' failed, first error: {result["first_error"]}'
+        for name, result in report['endpoints'].items()
+        if result['errors'] > 0
+    ])
+
+
+if __name__ == '__main__':
+    main()
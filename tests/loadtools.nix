@@ -0,0 +1,7 @@
+# A directory containing loadtools.py, to be added to the PYTHONPATH of the
+# tools importing it.
+{ pkgs }:
+
+pkgs.linkFarm "loadtools" [
+  { name = "loadtools.py"; path = ./loadtools.py; }
+]
@@ -0,0 +1,37 @@
+"""
+Helpers shared by the load and latency tools used in the tests, which are
+http-bench.py, talk/signaling-load.py and talk/turn-probe.py.
+"""
+import json
+import math
+import sys
+
+
+def percentiles(values):
+    result = {'count': len(values)}
+    ordered = sorted(values)
+    for point in (50, 95, 99):
+        if ordered:
+            rank = max(0, math.ceil(point / 100 * len(ordered)) - 1)
+            result[f'p{point}'] = ordered[rank]
+        else:
+            result[f'p{point}'] = None
+    result['max'] = ordered[-1] if ordered else None
+    return result
+
+
+def write_report(report, failures=()):
+    """
+    Write the report as JSON to stdout and exit with a non-zero status if
+    there were any failures, so that a test running the tool fails as well.
+
+    The report is written in any case, so it's still available for finding
+    out what went wrong.
+    """
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    sys.stdout.flush()
+    if failures:
+        for failure in failures:
+            sys.stderr.write(f'{failure}\n')
+        sys.exit(1)
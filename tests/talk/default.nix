@@ -62,6 +62,7 @@ import ../make-test.nix {
             p.setuptools p.systemd
           ])).interpreter
           "${./video-provider.py}"
+          "--direct"
           "User${toString num}"
         ];
       };
@@ -143,7 +144,13 @@ import ../make-test.nix {
             else:
               sys.stdout.write(str(ret))
         '';
-      in [ testClient pkgs.iptables ];
+        turnProbe = pkgs.writeScriptBin "turn-probe" ''
+          #!${pkgs.stdenv.shell}
+          export PYTHONPATH=${import ../loadtools.nix { inherit pkgs; }}
+          exec ${lib.escapeShellArg pkgs.python3.interpreter} \
+            ${lib.escapeShellArg "${./turn-probe.py}"} "$@"
+        '';
+      in [ testClient turnProbe pkgs.iptables ];
 
       hardware.pulseaudio.enable = true;
       hardware.pulseaudio.systemWide = true;
@@ -199,6 +206,15 @@ import ../make-test.nix {
         LD_PRELOAD = "${pkgs.libeatmydata}/lib/libeatmydata.so";
       };
 
+      environment.systemPackages = let
+        python = pkgs.python3.withPackages (p: [ p.requests p.websockets ]);
+      in lib.singleton (pkgs.writeScriptBin "signaling-load" ''
+        #!${pkgs.stdenv.shell}
+        export PYTHONPATH=${import ../loadtools.nix { inherit pkgs; }}
+        exec ${lib.escapeShellArg python.interpreter} \
+          ${lib.escapeShellArg "${./signaling-load.py}"} "$@"
+      '');
+
       virtualisation.memorySize = 2048;
       virtualisation.qemu.options = [ "-smp 4" ];
     };
@@ -209,6 +225,7 @@ import ../make-test.nix {
 
   testScript = ''
     # fmt: off
+    import json
     import os
     from pathlib import Path
     from shutil import copyfile
@@ -241,6 +258,20 @@ import ../make-test.nix {
         self.save_item('WebRTC info', 'webrtc.html', f'{name}.html',
                        'test-client webrtc_info')
 
+      def webrtc_stats(self, name, duration=10):
+        path = Path(os.environ['out']) / f'{name}.json'
+        with self.nested(f'saving WebRTC stats to {path!r}'):
+          stats = self.succeed(f'test-client webrtc_stats {duration}')
+          path.write_text(stats)
+        return json.loads(stats)
+
+      def save_timings(self, name):
+        path = Path(os.environ['out']) / f'{name}.json'
+        with self.nested(f'saving call setup timings to {path!r}'):
+          timings = self.succeed('test-client get_timings')
+          path.write_text(timings)
+        return json.loads(timings)
+
     # Monkey-add all the methods of ExtendedMachine to all Machine instances
     for attr in dir(ExtendedMachine):
       if attr.startswith('_'): continue
@@ -295,10 +326,62 @@ import ../make-test.nix {
       globals()[f'client{i}'].succeed('test-client start_call')
 
     client1.succeed('test-client wait_for_others')
+    client1.webrtc_stats('client1_webrtc_stats')
 
     for i in map(lambda x: x + 1, range(clients)):
       globals()[f'client{i}'].selenium_screenshot(f'client{i}_call_started')
       globals()[f'client{i}'].save_driver_log(f'client{i}_driver')
       globals()[f'client{i}'].save_html(f'client{i}_call_started')
+      globals()[f'client{i}'].save_timings(f'client{i}_timings')
+
+    with server.nested('generate load on the signaling server'):
+      token = url.rstrip('/').rsplit('/', 1)[-1]
+      # The load clients are distributed across a pool of users, so we're
+      # not measuring the sessions of a single user piling up.
+      load_users = []
+      for num in range(10):
+        user, password = f'loaduser{num}', f'Load-Password-{num}'
+        server.succeed(
+          f'OC_PASS={password} nextcloud-occ user:add'
+          f' --password-from-env {user} >&2'
+        )
+        load_users.append(f' --user {user}:{password}')
+      report = server.succeed(
+        'signaling-load --unix-socket /run/nextcloud-signaling-external.sock'
+        ' --nextcloud https://nextcloud --insecure'
+        + ''.join(load_users) + f' --room {token} --clients 50'
+      )
+      (Path(os.environ['out']) / 'signaling-load.json').write_text(report)
+
+    with client1.nested('probe the STUN/TURN server'):
+      secret = server.succeed(
+        '. /var/lib/nextcloud-coturn/secrets.env'
+        ' && echo -n "$COTURN_STATIC_AUTH_SECRET"'
+      )
+      report = client1.succeed(
+        f'turn-probe --server nextcloud:3478 --secret {secret}'
+        ' --bindings 1000 --allocations 100'
+      )
+      (Path(os.environ['out']) / 'turn-probe.json').write_text(report)
+
+    with client1.nested('log in via a session started from a profile'):
+      # A separate user, because a logged in profile must not share its
+      # PHP session with any other session.
+      server.succeed(
+        'OC_PASS=Dreb-Vimt4 nextcloud-occ user:add'
+        ' --password-from-env profileuser >&2'
+      )
+      client1.succeed('test-client build_profile prebuilt profileuser'
+                      ' Dreb-Vimt4')
+      client1.succeed('test-client new_session warm prebuilt')
+      # The session is restored from the cookies of the profile, so the
+      # password isn't even used and a wrong one needs to work as well.
+      client1.succeed('test-client warm.login profileuser wrong-password')
+      timings = json.loads(client1.succeed('test-client warm.get_timings'))
+      assert 'restore_session' in timings, timings
+      (Path(os.environ['out']) / 'client1_warm_timings.json').write_text(
+        json.dumps(timings)
+      )
+      client1.succeed('test-client close_session warm')
   '';
 } args
@@ -1,6 +1,18 @@
+import json
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from pathlib import Path
+from socketserver import ThreadingMixIn
 from xmlrpc.server import SimpleXMLRPCServer
 
 from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.firefox.options import Options
 
 from selenium.webdriver.common.by import By
@@ -8,113 +20,479 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 
 
+RE_SESSION_ID = re.compile(r'^[A-Za-z0-9_-]+$')
+
+PROFILE_DIR = Path('/tmp/profiles')
+
+PREFERENCES = {
+    'media.navigator.permission.disabled': False,
+
+    # Note that this isn't a boolean: 1 -> SitePermissions.ALLOW
+    'permissions.default.microphone': 1,
+    'permissions.default.camera': 1,
+
+    'media.video_loopback_dev': 'Dummy video device (0x0000)',
+    'media.audio_loopback_dev': 'Sine source at 440 Hz',
+    'media.cubeb.output_device': 'Null Output',
+    'media.volume_scale': '1.0',
+
+    'network.captive-portal-service.enabled': False,
+    'devtools.console.stdout.content': True,
+    'marionette.log.level': 'Trace',
+}
+
+REMOTE_VIDEO_CSS = \
+    '.videoContainer:not(.not-connected):not(.videoContainer-dummy)'
+
+# Waits until at least the given amount of elements matching a CSS selector or
+# an XPath expression satisfy a condition. Instead of polling via WebDriver,
+# this is done in the page whenever the DOM changes. If nothing is found
+# within the given amount of milliseconds, null is returned instead, so the
+# observer and the timers don't keep running after giving up.
+WAIT_SCRIPT = '''
+let [kind, query, condition, minCount, timeout, done] = arguments;
+let observer = null, timer = null, deadline = null, finished = false;
+
+function isVisible(el) {
+    if (el.getClientRects().length === 0) return false;
+    return getComputedStyle(el).visibility !== "hidden";
+}
+
+function matches(el) {
+    switch (condition) {
+        case "visible": return isVisible(el);
+        case "clickable": return isVisible(el) && !el.disabled;
+        default: return true;
+    }
+}
+
+function find() {
+    let elems = [];
+    if (kind === "xpath") {
+        let result = document.evaluate(
+            query, document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE,
+            null
+        );
+        for (let i = 0; i < result.snapshotLength; i++)
+            elems.push(result.snapshotItem(i));
+    } else {
+        elems = Array.from(document.querySelectorAll(query));
+    }
+    elems = elems.filter(matches);
+    return elems.length >= minCount ? elems : null;
+}
+
+function finish(result) {
+    finished = true;
+    if (observer !== null) observer.disconnect();
+    if (timer !== null) clearInterval(timer);
+    if (deadline !== null) clearTimeout(deadline);
+    done(result);
+}
+
+function check() {
+    if (finished) return;
+    let found = find();
+    if (found !== null) finish(found);
+}
+
+check();
+if (!finished) {
+    deadline = setTimeout(() => finish(null), timeout);
+    observer = new MutationObserver(check);
+    observer.observe(document, {
+        childList: true, subtree: true, attributes: true,
+    });
+    // Visibility might also change without any DOM mutation, for example
+    // when a stylesheet has finished loading.
+    timer = setInterval(check, 500);
+}
+'''
+
+PAGE_LOAD_SCRIPT = '''
+let done = arguments[0];
+if (document.readyState === "complete") done();
+else window.addEventListener("load", () => done());
+'''
+
+# Records the time of the call start and the time when the first frame of a
+# remote video is available, both relative to the page's time origin.
+REMOTE_FRAME_SCRIPT = '''
+let css = arguments[0];
+window.__callStart = performance.now();
+window.__firstRemoteFrame = null;
+if (window.__remoteFrameListener === undefined) {
+    window.__remoteFrameListener = ev => {
+        if (window.__firstRemoteFrame !== null) return;
+        if (ev.target.tagName === "VIDEO" && ev.target.closest(css) !== null)
+            window.__firstRemoteFrame = performance.now();
+    };
+    document.addEventListener("loadeddata", window.__remoteFrameListener,
+                              true);
+}
+'''
+
+TIMINGS_SCRIPT = '''
+if (window.__callStart === undefined || window.__firstRemoteFrame === null)
+    return null;
+return (window.__firstRemoteFrame - window.__callStart) / 1000;
+'''
+
+# Talk doesn't expose its peer connections, so we hook into the prototype in
+# order to keep track of every connection that's negotiated in the page.
+PC_HOOK_SCRIPT = '''
+if (window.__peerConnections === undefined) {
+    window.__peerConnections = [];
+    window.__nextPeerConnectionId = 0;
+    let proto = RTCPeerConnection.prototype;
+    for (let name of ["setLocalDescription", "setRemoteDescription"]) {
+        let orig = proto[name];
+        proto[name] = function(...args) {
+            if (this.__statsId === undefined) {
+                this.__statsId = window.__nextPeerConnectionId++;
+                window.__peerConnections.push(this);
+            }
+            return orig.apply(this, args);
+        };
+    }
+}
+'''
+
+# Polls getStats() of all the known peer connections at a fixed interval and
+# returns the cumulative counters of every connection for each sample.
+#
+# Talk closes and recreates connections on renegotiation, so closed
+# connections are dropped and an error of a single connection is only
+# recorded in its own sample instead of failing the whole collection.
+COLLECT_STATS_SCRIPT = '''
+let [duration, interval, done] = arguments;
+let samples = [];
+
+async function snapshot(pc) {
+    let stats = await pc.getStats();
+    let result = {
+        connection: pc.__statsId, state: pc.iceConnectionState,
+        timestamp: performance.timeOrigin + performance.now(),
+        bytesReceived: 0, bytesSent: 0, packetsReceived: 0,
+        packetsLost: 0, jitter: null, rtt: null, framesDecoded: 0,
+        framesDropped: 0, localCandidateType: null,
+        remoteCandidateType: null,
+    };
+    let pair = null;
+    stats.forEach(report => {
+        switch (report.type) {
+            case "inbound-rtp":
+                if (report.isRemote) break;
+                result.bytesReceived += report.bytesReceived || 0;
+                result.packetsReceived += report.packetsReceived || 0;
+                result.packetsLost += report.packetsLost || 0;
+                result.framesDecoded += report.framesDecoded || 0;
+                result.framesDropped += report.framesDropped || 0;
+                if (report.jitter !== undefined)
+                    result.jitter = Math.max(result.jitter || 0,
+                                             report.jitter);
+                break;
+            case "outbound-rtp":
+                if (report.isRemote) break;
+                result.bytesSent += report.bytesSent || 0;
+                break;
+            case "remote-inbound-rtp":
+                if (report.roundTripTime !== undefined)
+                    result.rtt = report.roundTripTime;
+                break;
+            case "candidate-pair":
+                if (report.selected || (report.nominated &&
+                                        report.state === "succeeded"))
+                    pair = report;
+                break;
+        }
+    });
+    if (pair !== null) {
+        let local = stats.get(pair.localCandidateId);
+        let remote = stats.get(pair.remoteCandidateId);
+        result.localCandidateType = local ? local.candidateType : null;
+        result.remoteCandidateType = remote ? remote.candidateType : null;
+        if (result.rtt === null && pair.currentRoundTripTime !== undefined)
+            result.rtt = pair.currentRoundTripTime;
+    }
+    return result;
+}
+
+async function trySnapshot(pc) {
+    try {
+        return await snapshot(pc);
+    } catch (err) {
+        return {
+            connection: pc.__statsId, state: pc.iceConnectionState,
+            timestamp: performance.timeOrigin + performance.now(),
+            error: err.toString(),
+        };
+    }
+}
+
+async function collect() {
+    let end = performance.now() + duration;
+    while (true) {
+        let pcs = (window.__peerConnections || [])
+            .filter(pc => pc.signalingState !== "closed");
+        window.__peerConnections = pcs;
+        samples.push(await Promise.all(pcs.map(trySnapshot)));
+        let delay = Math.min(interval, end - performance.now());
+        if (delay <= 0) break;
+        await new Promise(resolve => setTimeout(resolve, delay));
+    }
+}
+
+collect().then(() => done(JSON.stringify(samples)),
+               err => done(JSON.stringify({error: err.toString()})));
+'''
+
+
+def _bitrate(cur, prev, key, seconds):
+    if prev is None or seconds <= 0:
+        return None
+    return (cur[key] - prev[key]) * 8 / seconds
+
+
+def _stats_to_series(samples):
+    """
+    Turn the raw samples of cumulative counters into a time series per
+    connection with bitrates and packet loss for every interval.
+    """
+    series = {}
+    previous = {}
+    for sample in samples:
+        for cur in sample:
+            conn = str(cur['connection'])
+            if 'error' in cur:
+                series.setdefault(conn, []).append({
+                    'timestamp': cur['timestamp'],
+                    'state': cur['state'],
+                    'error': cur['error'],
+                })
+                continue
+
+            prev = previous.get(conn)
+            seconds = 0
+            if prev is not None:
+                seconds = (cur['timestamp'] - prev['timestamp']) / 1000
+
+            packet_loss = None
+            if prev is not None:
+                lost = cur['packetsLost'] - prev['packetsLost']
+                received = cur['packetsReceived'] - prev['packetsReceived']
+                if lost + received > 0:
+                    packet_loss = max(lost, 0) / (lost + received)
+
+            series.setdefault(conn, []).append({
+                'timestamp': cur['timestamp'],
+                'state': cur['state'],
+                'inbound_bitrate': _bitrate(cur, prev, 'bytesReceived',
+                                            seconds),
+                'outbound_bitrate': _bitrate(cur, prev, 'bytesSent', seconds),
+                'packets_lost': cur['packetsLost'],
+                'packet_loss': packet_loss,
+                'jitter': cur['jitter'],
+                'rtt': cur['rtt'],
+                'frames_decoded': cur['framesDecoded'],
+                'frames_dropped': cur['framesDropped'],
+                'local_candidate_type': cur['localCandidateType'],
+                'remote_candidate_type': cur['remoteCandidateType'],
+            })
+            previous[conn] = cur
+    return series
+
+
+class Profile:
+    """
+    A template for Firefox profiles, which has all the preferences in place
+    and has already been started once, so that new sessions can start from a
+    copy of it instead of a cold profile.
+
+    If a user is given, the template also logs in once and keeps the cookies,
+    so sessions using the profile are already logged in. Since Talk keeps the
+    participant state in the PHP session, such a profile should only be used
+    by one session at a time.
+    """
+    def __init__(self, name):
+        if RE_SESSION_ID.match(name) is None:
+            raise ValueError(f'Invalid profile name {name!r}.')
+        self.name = name
+        self.path = PROFILE_DIR / name
+        self.user = None
+        self.cookies = []
+
+    def build(self, user=None, passwd=None):
+        if self.path.exists():
+            shutil.rmtree(self.path)
+        self.path.mkdir(parents=True)
+        with open(self.path / 'user.js', 'w') as fp:
+            for key, value in PREFERENCES.items():
+                fp.write(f'user_pref({json.dumps(key)},'
+                         f' {json.dumps(value)});\n')
+
+        driver = Driver(f'-profile-{self.name}', profile_dir=self.path)
+        try:
+            if user is not None:
+                driver.login(user, passwd)
+                self.user = user
+                self.cookies = driver.driver.get_cookies()
+        finally:
+            driver.quit()
+
+    def copy(self):
+        dest = tempfile.mkdtemp(prefix=f'{self.name}-', dir=PROFILE_DIR)
+        ignore = shutil.ignore_patterns('lock', '.parentlock')
+        shutil.copytree(self.path, dest, ignore=ignore, dirs_exist_ok=True)
+        return Path(dest)
+
+
 class Driver:
-    def __init__(self):
+    # The methods which can be called via RPC. Everything else, especially
+    # quit(), is only used by the SessionPool managing the sessions.
+    RPC_METHODS = frozenset([
+        'login', 'create_conversation', 'join_conversation', 'start_call',
+        'wait_for_others', 'get_timings', 'webrtc_info', 'webrtc_stats',
+        'screenshot', 'save_html',
+    ])
+
+    def __init__(self, suffix='', profile=None, profile_dir=None):
+        self.suffix = suffix
+        self.timings = {}
+        self.user = None
+
+        # The copy of the profile to remove when quitting.
+        self.profile_copy = None
+        if profile is not None:
+            with self._timed('profile_copy'):
+                profile_dir = self.profile_copy = profile.copy()
+
         options = Options()
         options.add_argument('--headless')
         options.add_argument('--width=1920')
         options.add_argument('--height=1080')
-        options.set_preference('media.navigator.permission.disabled', False)
 
-        # Note that this isn't a boolean: 1 -> SitePermissions.ALLOW
-        options.set_preference('permissions.default.microphone', 1)
-        options.set_preference('permissions.default.camera', 1)
-
-        options.set_preference('media.video_loopback_dev',
-                               'Dummy video device (0x0000)')
-        options.set_preference('media.audio_loopback_dev',
-                               'Sine source at 440 Hz')
-        options.set_preference('media.cubeb.output_device', 'Null Output')
-        options.set_preference('media.volume_scale', '1.0')
-
-        options.set_preference('network.captive-portal-service.enabled', False)
-        options.set_preference('devtools.console.stdout.content', True)
-        options.set_preference('marionette.log.level', 'Trace')
+        if profile_dir is None:
+            for key, value in PREFERENCES.items():
+                options.set_preference(key, value)
+        else:
+            # The preferences are already in the user.js of the profile.
+            options.add_argument('-profile')
+            options.add_argument(str(profile_dir))
+
+        with self._timed('startup'):
+            self.driver = webdriver.Firefox(
+                options=options,
+                service_log_path=f'/tmp/xchg/driver{suffix}.log'
+            )
+        self.wait = WebDriverWait(self.driver, 60)
 
-        self.driver = webdriver.Firefox(
-            options=options, service_log_path='/tmp/xchg/driver.log'
+        if profile is not None and profile.cookies:
+            with self._timed('restore_session'):
+                # Cookies can only be added for the domain of the current
+                # page, so we need to load a (cheap) page there first.
+                self.driver.get('https://nextcloud/status.php')
+                for cookie in profile.cookies:
+                    self.driver.add_cookie(cookie)
+                self.user = profile.user
+
+    @contextmanager
+    def _timed(self, phase):
+        start = time.monotonic()
+        yield
+        self.timings[phase] = time.monotonic() - start
+
+    def _wait_for(self, query, kind='css', condition='visible', count=1,
+                  timeout=60):
+        # Leave the script enough time to give up on its own, so it can clean
+        # up after itself before WebDriver stops waiting for it.
+        self.driver.set_script_timeout(timeout + 10)
+        found = self.driver.execute_async_script(
+            WAIT_SCRIPT, kind, query, condition, count, timeout * 1000
         )
-        self.wait = WebDriverWait(self.driver, 60)
+        if found is None:
+            raise TimeoutException(f'No {count} {condition} element(s)'
+                                   f' matching {query!r} after {timeout}s.')
+        return found[0]
 
     def login(self, name, passwd):
-        self.driver.get('https://nextcloud/')
-        self.driver.find_element_by_id('user').send_keys(name)
-        self.driver.find_element_by_id('password').send_keys(passwd)
-        self.driver.find_element_by_id('submit-form').click()
-
-        self.wait.until(EC.visibility_of_element_located(
-            (By.ID, 'app-dashboard')
-        ))
-
-    def create_conversation(self, name):
-        self.wait.until(EC.visibility_of_element_located(
-            (By.CSS_SELECTOR, '#appmenu *[data-id=spreed] a')
-        )).click()
+        with self._timed('login'):
+            self.driver.get('https://nextcloud/')
+            # The session has been restored from the profile.
+            if self.user == name:
+                self._wait_for('#app-dashboard')
+                return
 
-        self.wait.until(EC.element_to_be_clickable(
-            (By.CSS_SELECTOR, '.new-conversation button')
-        )).click()
+            self.driver.find_element_by_id('user').send_keys(name)
+            self.driver.find_element_by_id('password').send_keys(passwd)
+            self.driver.find_element_by_id('submit-form').click()
 
-        self.wait.until(EC.visibility_of_element_located(
-            (By.CSS_SELECTOR, 'input.conversation-name')
-        )).send_keys(name)
-
-        xpath = '//label[normalize-space()="Allow guests to join via link"]'
-        self.wait.until(EC.element_to_be_clickable((By.XPATH, xpath))).click()
-
-        xpath = '//button[normalize-space()="Add participants"]'
-        self.wait.until(EC.element_to_be_clickable((By.XPATH, xpath))).click()
-
-        xpath = '//button[normalize-space()="Create conversation"]'
-        self.wait.until(EC.element_to_be_clickable((By.XPATH, xpath))).click()
+            self._wait_for('#app-dashboard')
 
-        xpath = '//div[@class="navigation"]/button[normalize-space()="Close"]'
-        self.wait.until(EC.element_to_be_clickable((By.XPATH, xpath))).click()
+    def create_conversation(self, name):
+        with self._timed('create_conversation'):
+            self._wait_for('#appmenu *[data-id=spreed] a').click()
+            self._wait_for('.new-conversation button',
+                           condition='clickable').click()
+            self._wait_for('input.conversation-name').send_keys(name)
+
+            for xpath in [
+                '//label[normalize-space()="Allow guests to join via link"]',
+                '//button[normalize-space()="Add participants"]',
+                '//button[normalize-space()="Create conversation"]',
+                '//div[@class="navigation"]/button[normalize-space()="Close"]',
+            ]:
+                self._wait_for(xpath, kind='xpath',
+                               condition='clickable').click()
 
         return self.driver.current_url
 
     def join_conversation(self, url):
-        self.driver.get(url)
-        self.wait.until(EC.visibility_of_element_located(
-            (By.CLASS_NAME, 'new-message-form')
-        ))
-
-        self._wait_for_page_load()
+        with self._timed('join'):
+            self.driver.get(url)
+            self._wait_for('.new-message-form')
+            self._wait_for_page_load()
 
     def start_call(self):
-        selector = 'button .icon-start-call, button .icon-incoming-call'
-        locator = (By.CSS_SELECTOR, selector)
-        self.wait.until(EC.element_to_be_clickable(locator)).click()
-
-        for button, disabled_cls in [('mute', 'audio-disabled'),
-                                     ('hideVideo', 'video-disabled')]:
-            elem = self.wait.until(EC.element_to_be_clickable(
-                (By.ID, button)
-            ))
-            if disabled_cls in elem.get_attribute('class').split():
-                elem.click()
-                elem = self.wait.until(EC.element_to_be_clickable(
-                    (By.CSS_SELECTOR, f'#{button}:not(.{disabled_cls})')
-                ))
-
-    def _wait_for_page_load(self):
-        def _check_page_load(driver):
-            ready_state = driver.execute_script('return document.readyState;')
-            return ready_state == 'complete'
-
-        self.wait.until(_check_page_load)
+        self.driver.execute_script(PC_HOOK_SCRIPT)
+
+        with self._timed('call_start'):
+            selector = 'button .icon-start-call, button .icon-incoming-call'
+            elem = self._wait_for(selector, condition='clickable')
+            self.driver.execute_script(REMOTE_FRAME_SCRIPT, REMOTE_VIDEO_CSS)
+            elem.click()
+
+            for button, disabled_cls in [('mute', 'audio-disabled'),
+                                         ('hideVideo', 'video-disabled')]:
+                elem = self._wait_for(f'#{button}', condition='clickable')
+                if disabled_cls in elem.get_attribute('class').split():
+                    elem.click()
+                    self._wait_for(f'#{button}:not(.{disabled_cls})',
+                                   condition='clickable')
+
+    def _wait_for_page_load(self, timeout=60):
+        self.driver.set_script_timeout(timeout)
+        self.driver.execute_async_script(PAGE_LOAD_SCRIPT)
 
     def wait_for_others(self):
-        css = '.videoContainer:not(.not-connected):not(.videoContainer-dummy)'
-
-        def _check_remote_video_elements(driver):
-            vidcontainers = driver.find_elements_by_css_selector(css)
+        with self._timed('wait_for_others'):
             # XXX: This should really be the number of the actual peers but
             #      unfortunately there is still a reliability issue and nodes
             #      sometimes fail to establish a stream.
-            return len(vidcontainers) >= 2
-
-        WebDriverWait(self.driver, 300).until(_check_remote_video_elements)
+            self._wait_for(REMOTE_VIDEO_CSS, condition='present', count=2,
+                           timeout=300)
+
+    def get_timings(self):
+        """
+        Return the durations in seconds of all the phases run so far and the
+        time from starting the call until the first remote video frame as
+        JSON.
+        """
+        result = dict(self.timings)
+        first_frame = self.driver.execute_script(TIMINGS_SCRIPT)
+        if first_frame is not None:
+            result['first_remote_frame'] = first_frame
+        return json.dumps(result)
 
     def webrtc_info(self):
         curwin = self.driver.current_window_handle
@@ -140,18 +518,177 @@ class Driver:
         ''')
         self.driver.close()
         self.driver.switch_to_window(curwin)
-        with open('/tmp/xchg/webrtc.html', 'w') as webrtc:
+        with open(f'/tmp/xchg/webrtc{self.suffix}.html', 'w') as webrtc:
             webrtc.write(source)
 
+    def webrtc_stats(self, duration=10, interval=1):
+        """
+        Poll getStats() of all peer connections every 'interval' seconds for
+        'duration' seconds and return a JSON time series per connection.
+        """
+        duration, interval = float(duration), float(interval)
+        self.driver.set_script_timeout(duration + 30)
+        result = json.loads(self.driver.execute_async_script(
+            COLLECT_STATS_SCRIPT, duration * 1000, interval * 1000
+        ))
+        if isinstance(result, dict):
+            raise RuntimeError(f"Unable to collect WebRTC stats: {result}")
+        return json.dumps(_stats_to_series(result))
+
     def screenshot(self):
-        self.driver.save_screenshot('/tmp/xchg/screenshot.png')
+        self.driver.save_screenshot(f'/tmp/xchg/screenshot{self.suffix}.png')
 
     def save_html(self):
-        with open('/tmp/xchg/page.html', 'w') as page:
+        with open(f'/tmp/xchg/page{self.suffix}.html', 'w') as page:
             page.write(self.driver.page_source)
 
-
-server = SimpleXMLRPCServer(('localhost', 1234), allow_none=True)
-server.register_introspection_functions()
-server.register_instance(Driver())
-server.serve_forever()
+    def quit(self):
+        self.driver.quit()
+        if self.profile_copy is not None:
+            shutil.rmtree(self.profile_copy, ignore_errors=True)
+
+
+class _Reservation:
+    """
+    Placeholder for a session whose browser is still starting up.
+    """
+
+
+class SessionPool:
+    """
+    Manages several browser sessions in one process, so that a single
+    machine can act as several call participants.
+
+    Methods of a specific session are called via '<session id>.<method>',
+    while calling '<method>' without a session id uses the default session.
+    Calls to different sessions run concurrently, but calls to the same
+    session are serialised, since WebDriver isn't thread-safe.
+
+    New sessions can be started from a profile built via 'build_profile',
+    which defaults to the given default profile if there is one.
+    """
+    DEFAULT = 'default'
+
+    def __init__(self, default_profile=None):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.session_locks = {}
+        self.counter = 0
+        self.profiles = {}
+        if default_profile is not None:
+            self.profiles[default_profile.name] = default_profile
+        self.default_profile = default_profile
+
+    def build_profile(self, name, user=None, passwd=None):
+        profile = Profile(name)
+        profile.build(user, passwd)
+        with self.lock:
+            self.profiles[name] = profile
+        return name
+
+    def new_session(self, sid=None, profile=None):
+        with self.lock:
+            if profile is None:
+                profile_obj = self.default_profile
+            elif profile in self.profiles:
+                profile_obj = self.profiles[profile]
+            else:
+                raise KeyError(f'Profile {profile!r} does not exist.')
+
+            if sid is None:
+                self.counter += 1
+                sid = f'session{self.counter}'
+            if RE_SESSION_ID.match(sid) is None:
+                raise ValueError(f'Invalid session id {sid!r}.')
+            if sid in self.sessions:
+                raise ValueError(f'Session {sid!r} already exists.')
+            # Reserve the session id while the browser is starting up. The
+            # reservation is unique, so we can tell whether the session has
+            # been closed in the meantime, even if the same id has been
+            # reserved again afterwards.
+            reservation = _Reservation()
+            self.sessions[sid] = reservation
+            self.session_locks[sid] = threading.Lock()
+
+        suffix = '' if sid == self.DEFAULT else f'-{sid}'
+        try:
+            driver = Driver(suffix, profile_obj)
+        except Exception:
+            with self.lock:
+                if self.sessions.get(sid) is reservation:
+                    del self.sessions[sid]
+                    del self.session_locks[sid]
+            raise
+
+        with self.lock:
+            if self.sessions.get(sid) is reservation:
+                self.sessions[sid] = driver
+                return sid
+
+        driver.quit()
+        raise RuntimeError(f'Session {sid!r} has been closed while starting.')
+
+    def close_session(self, sid):
+        with self.lock:
+            driver = self.sessions.pop(sid)
+            session_lock = self.session_locks.pop(sid)
+        # The session is still starting up, so new_session() quits the
+        # browser as soon as it's running.
+        if isinstance(driver, _Reservation):
+            return
+        with session_lock:
+            driver.quit()
+
+    def list_sessions(self):
+        with self.lock:
+            return [sid for sid, driver in self.sessions.items()
+                    if not isinstance(driver, _Reservation)]
+
+    def _dispatch(self, method, params):
+        if method in ('new_session', 'close_session', 'list_sessions',
+                      'build_profile'):
+            return getattr(self, method)(*params)
+
+        sid, _, name = method.rpartition('.')
+        if not sid:
+            sid = self.DEFAULT
+
+        if name not in Driver.RPC_METHODS:
+            raise AttributeError(f'Method {name!r} is not available.')
+
+        with self.lock:
+            driver = self.sessions.get(sid)
+            session_lock = self.session_locks.get(sid)
+        if driver is None or isinstance(driver, _Reservation):
+            raise KeyError(f'Session {sid!r} does not exist.')
+
+        with session_lock:
+            return getattr(driver, name)(*params)
+
+
+class ThreadingXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Browser driver for Talk tests')
+    parser.add_argument('--no-default-session', action='store_true',
+                        help="Don't start a browser session on startup")
+    parser.add_argument('--warm-profile', action='store_true',
+                        help='Build a profile on startup and start all'
+                        ' sessions from copies of it by default')
+    options = parser.parse_args()
+
+    default_profile = None
+    if options.warm_profile:
+        default_profile = Profile(SessionPool.DEFAULT)
+        default_profile.build()
+
+    pool = SessionPool(default_profile)
+    if not options.no_default_session:
+        pool.new_session(SessionPool.DEFAULT)
+
+    server = ThreadingXMLRPCServer(('localhost', 1234), allow_none=True)
+    server.register_introspection_functions()
+    server.register_instance(pool)
+    server.serve_forever()
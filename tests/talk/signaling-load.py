@@ -0,0 +1,492 @@
+import asyncio
+import itertools
+import json
+import os
+import ssl
+import tempfile
+import time
+import uuid
+
+from argparse import ArgumentParser
+from collections import defaultdict
+
+import requests
+import websockets
+
+from loadtools import percentiles, write_report
+
+OCS_HEADERS = {'OCS-APIRequest': 'true', 'Accept': 'application/json'}
+TALK_API = '/ocs/v2.php/apps/spreed/api'
+
+# Not a valid session description, but the signaling server doesn't care.
+FAKE_SDP = 'v=0\r\no=- 0 0 IN IP4 127.0.0.1\r\ns=-\r\nt=0 0\r\n'
+
+
+class NextcloudAuth:
+    """
+    Fetch a signaling ticket and join the Talk room via the OCS API, which is
+    what the Talk web client does before connecting to the signaling server.
+
+    Talk ties the room session to the PHP session, so every client gets its
+    own HTTP session, otherwise clients of the same user would replace each
+    other's room sessions.
+    """
+    def __init__(self, baseurl, user, password, verify=True):
+        self.baseurl = baseurl.rstrip('/')
+        self.auth = (user, password)
+        self.verify = verify
+
+    def _new_session(self):
+        session = requests.Session()
+        session.auth = self.auth
+        session.headers.update(OCS_HEADERS)
+        session.verify = self.verify
+        return session
+
+    @property
+    def backend_url(self):
+        return self.baseurl + TALK_API + '/v1/signaling/backend'
+
+    def _ocs(self, session, method, path, **kwargs):
+        url = self.baseurl + TALK_API + path
+        response = session.request(method, url, **kwargs)
+        response.raise_for_status()
+        return response.json()['ocs']['data']
+
+    def _join_room(self, session, room):
+        for version in ('v4', 'v1'):
+            path = f'/{version}/room/{room}/participants/active'
+            try:
+                return self._ocs(session, 'POST', path)['sessionId']
+            except requests.HTTPError as e:
+                if e.response.status_code != 404:
+                    raise
+        raise IOError(f'Unable to join room {room!r}.')
+
+    def get_credentials(self, room):
+        with self._new_session() as session:
+            settings = self._ocs(session, 'GET', '/v1/signaling/settings',
+                                 params={'token': room})
+            auth = {
+                'url': self.backend_url,
+                'params': {'userid': settings['userId'],
+                           'ticket': settings['ticket']},
+            }
+            return auth, self._join_room(session, room)
+
+
+class StandInAuth:
+    def __init__(self):
+        self.counter = itertools.count(1)
+
+    def get_credentials(self, room):
+        auth = {'url': 'stand-in',
+                'params': {'userid': f'user{next(self.counter)}',
+                           'ticket': ''}}
+        return auth, uuid.uuid4().hex
+
+
+class Stats:
+    def __init__(self):
+        self.setup_times = []
+        self.setup_errors = []
+        self.failures = []
+        self.latencies = defaultdict(list)
+        self.sent = defaultdict(int)
+
+
+class Client:
+    def __init__(self, room, stats):
+        self.room = room
+        self.stats = stats
+        self.sessionid = None
+        self.members = set()
+        self.members_changed = asyncio.Event()
+        self.pending = {}
+        self.counter = 0
+        self.websocket = None
+        self.reader = None
+
+    async def connect(self, url, unix_socket=None, ssl_context=None):
+        if unix_socket is None:
+            self.websocket = await websockets.connect(url, ssl=ssl_context)
+        else:
+            self.websocket = await websockets.unix_connect(unix_socket, url)
+        self.reader = asyncio.ensure_future(self._read())
+
+    async def close(self):
+        if self.websocket is not None:
+            await self.websocket.close()
+        if self.reader is not None:
+            await asyncio.gather(self.reader, return_exceptions=True)
+
+    async def _request(self, msgtype, body):
+        self.counter += 1
+        msgid = str(self.counter)
+        future = asyncio.get_event_loop().create_future()
+        self.pending[msgid] = future
+        await self.websocket.send(json.dumps({
+            'id': msgid, 'type': msgtype, msgtype: body
+        }))
+        return await future
+
+    async def _read(self):
+        try:
+            async for raw in self.websocket:
+                self._handle(json.loads(raw))
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(IOError('Connection closed.'))
+
+    def _handle(self, msg):
+        future = self.pending.pop(msg.get('id'), None)
+        if future is not None:
+            if msg['type'] == 'error':
+                future.set_exception(IOError(msg['error']['message']))
+            else:
+                future.set_result(msg)
+        elif msg['type'] == 'event' and msg['event']['target'] == 'room':
+            event = msg['event']
+            if event['type'] == 'join':
+                self.members.update(entry['sessionid']
+                                    for entry in event['join'])
+            elif event['type'] == 'leave':
+                self.members.difference_update(event['leave'])
+            self.members_changed.set()
+        elif msg['type'] == 'message':
+            data = msg['message']['data']
+            if msg['message']['sender'].get('sessionid') == self.sessionid:
+                return
+            if isinstance(data, dict) and 'sent' in data:
+                latency = time.monotonic() - data['sent']
+                self.stats.latencies[data['type']].append(latency)
+
+    async def hello(self, auth):
+        reply = await self._request('hello', {'version': '1.0',
+                                              'auth': auth})
+        self.sessionid = reply['hello']['sessionid']
+
+    async def join(self, sessionid):
+        await self._request('room', {'roomid': self.room,
+                                     'sessionid': sessionid})
+
+    async def wait_for_members(self, sessionids):
+        while not sessionids <= self.members:
+            self.members_changed.clear()
+            await self.members_changed.wait()
+
+    async def send(self, recipient, data):
+        data['sent'] = time.monotonic()
+        self.stats.sent[data['type']] += 1
+        await self.websocket.send(json.dumps({
+            'type': 'message',
+            'message': {'recipient': recipient, 'data': data},
+        }))
+
+    async def exchange(self, peers, candidates, broadcasts):
+        """
+        Send offers and candidates to the given peers, which should only be
+        other load clients, since real participants like browsers in the
+        same room would try to handle them.
+        """
+        for peer in peers:
+            recipient = {'type': 'session', 'sessionid': peer}
+            await self.send(recipient, {
+                'type': 'offer', 'to': peer, 'roomType': 'video',
+                'payload': {'type': 'offer', 'sdp': FAKE_SDP},
+            })
+            for num in range(candidates):
+                await self.send(recipient, {
+                    'type': 'candidate', 'to': peer, 'roomType': 'video',
+                    'payload': {'candidate': {
+                        'candidate': f'candidate:{num} 1 UDP 2122252543'
+                                     f' 127.0.0.1 {10000 + num} typ host',
+                        'sdpMLineIndex': 0, 'sdpMid': '0',
+                    }},
+                })
+        for _ in range(broadcasts):
+            await self.send({'type': 'room'}, {'type': 'broadcast'})
+
+
+class StandIn:
+    """
+    A minimal stand-in for the signaling server, which only implements hello,
+    joining rooms and relaying messages to sessions or whole rooms.
+    """
+    def __init__(self):
+        self.sessions = {}
+        self.rooms = defaultdict(dict)
+
+    async def _send(self, websocket, msg):
+        try:
+            await websocket.send(json.dumps(msg))
+        except websockets.ConnectionClosed:
+            pass
+
+    async def _leave(self, sessionid, room):
+        members = self.rooms[room]
+        members.pop(sessionid, None)
+        event = {'type': 'event', 'event': {
+            'target': 'room', 'type': 'leave', 'leave': [sessionid],
+        }}
+        for websocket, _ in members.values():
+            await self._send(websocket, event)
+
+    async def _join(self, sessionid, room):
+        members = self.rooms[room]
+        websocket, userid = self.sessions[sessionid]
+        members[sessionid] = (websocket, userid)
+        entry = {'sessionid': sessionid, 'userid': userid}
+        for other, (otherws, _) in members.items():
+            if other == sessionid:
+                join = [{'sessionid': sid, 'userid': uid}
+                        for sid, (_, uid) in members.items()]
+            else:
+                join = [entry]
+            await self._send(otherws, {'type': 'event', 'event': {
+                'target': 'room', 'type': 'join', 'join': join,
+            }})
+
+    async def handle(self, websocket, path=None):
+        sessionid = room = None
+        try:
+            async for raw in websocket:
+                msg = json.loads(raw)
+                reply = {'id': msg['id']} if 'id' in msg else {}
+                if msg['type'] == 'hello':
+                    sessionid = uuid.uuid4().hex
+                    userid = msg['hello']['auth']['params'].get('userid')
+                    self.sessions[sessionid] = (websocket, userid)
+                    reply.update(type='hello', hello={
+                        'version': '1.0', 'sessionid': sessionid,
+                        'resumeid': uuid.uuid4().hex, 'userid': userid,
+                        'server': {'version': 'stand-in', 'features': []},
+                    })
+                    await self._send(websocket, reply)
+                elif sessionid is None:
+                    reply.update(type='error', error={
+                        'code': 'hello_expected',
+                        'message': 'Expected Hello request.',
+                    })
+                    await self._send(websocket, reply)
+                elif msg['type'] == 'room':
+                    if room is not None:
+                        await self._leave(sessionid, room)
+                    room = msg['room']['roomid']
+                    reply.update(type='room', room={'roomid': room})
+                    await self._send(websocket, reply)
+                    await self._join(sessionid, room)
+                elif msg['type'] == 'message':
+                    recipient = msg['message']['recipient']
+                    out = {'type': 'message', 'message': {
+                        'sender': {'type': 'session', 'sessionid': sessionid,
+                                   'userid': self.sessions[sessionid][1]},
+                        'data': msg['message']['data'],
+                    }}
+                    if recipient['type'] == 'session':
+                        target = self.sessions.get(recipient['sessionid'])
+                        targets = [] if target is None else [target[0]]
+                    else:
+                        targets = [ws for sid, (ws, _)
+                                   in self.rooms.get(room, {}).items()
+                                   if sid != sessionid]
+                    for target_ws in targets:
+                        await self._send(target_ws, out)
+                elif msg['type'] == 'bye':
+                    reply.update(type='bye', bye={})
+                    await self._send(websocket, reply)
+                    break
+        finally:
+            if sessionid is not None:
+                if room is not None:
+                    await self._leave(sessionid, room)
+                del self.sessions[sessionid]
+
+
+async def setup_client(client, auth, options, stats, semaphore):
+    async with semaphore:
+        start = time.monotonic()
+        try:
+            loop = asyncio.get_event_loop()
+            credentials, ncsession = await loop.run_in_executor(
+                None, auth.get_credentials, client.room
+            )
+            await client.connect(options.url, options.unix_socket,
+                                 options.ssl_context)
+            await client.hello(credentials)
+            await client.join(ncsession)
+        except Exception as e:
+            stats.setup_errors.append(str(e))
+            await client.close()
+            return False
+        stats.setup_times.append(time.monotonic() - start)
+        return True
+
+
+async def run_load(options, auths):
+    stats = Stats()
+    semaphore = asyncio.Semaphore(options.concurrency)
+    clients = [Client(options.rooms[num % len(options.rooms)], stats)
+               for num in range(options.clients)]
+
+    start = time.monotonic()
+    results = await asyncio.gather(*(
+        setup_client(client, auths[num % len(auths)], options, stats,
+                     semaphore)
+        for num, client in enumerate(clients)
+    ))
+    setup_duration = time.monotonic() - start
+    connected = [client for client, ok in zip(clients, results) if ok]
+
+    # The sessions of the load clients per room, so that messages are only
+    # exchanged between them and not with other participants of the room.
+    room_sessions = defaultdict(set)
+    for client in connected:
+        room_sessions[client.room].add(client.sessionid)
+
+    def get_peers(client):
+        return room_sessions[client.room] - {client.sessionid}
+
+    expected = received = 0
+    try:
+        await asyncio.wait_for(asyncio.gather(*(
+            client.wait_for_members(get_peers(client))
+            for client in connected
+        )), options.timeout)
+    except asyncio.TimeoutError:
+        stats.failures.append('Not all clients have seen the other clients'
+                              f' joining within {options.timeout} seconds.')
+    else:
+        await asyncio.gather(*(
+            client.exchange(get_peers(client), options.candidates,
+                            options.broadcasts)
+            for client in connected
+        ))
+
+        # Every broadcast is received by all the other room members, but
+        # only the ones received by load clients can be counted.
+        expected = stats.sent['offer'] + stats.sent['candidate']
+        expected += sum(len(sessions) * (len(sessions) - 1)
+                        * options.broadcasts
+                        for sessions in room_sessions.values())
+
+        # Wait until either all the messages have arrived or the timeout
+        # has been reached.
+        deadline = time.monotonic() + options.timeout
+        while time.monotonic() < deadline:
+            received = sum(len(lat) for lat in stats.latencies.values())
+            if received >= expected:
+                break
+            await asyncio.sleep(0.1)
+    finally:
+        await asyncio.gather(*(client.close() for client in connected))
+
+    report = {
+        'clients': options.clients,
+        'connected': len(connected),
+        'setup': {
+            'duration': setup_duration,
+            'rate': len(connected) / setup_duration,
+            'errors': len(stats.setup_errors),
+            'latency': percentiles(stats.setup_times),
+        },
+        'messages': {
+            kind: dict(percentiles(stats.latencies[kind]),
+                       sent=stats.sent[kind])
+            for kind in sorted(stats.sent)
+        },
+        'fanout': percentiles([latency
+                               for values in stats.latencies.values()
+                               for latency in values]),
+        'expected': expected,
+        'received': received,
+        'failures': stats.failures,
+    }
+    if stats.setup_errors:
+        report['setup']['first_error'] = stats.setup_errors[0]
+    return report
+
+
+async def run_with_stand_in(options):
+    standin = StandIn()
+    with tempfile.TemporaryDirectory() as tempdir:
+        options.unix_socket = os.path.join(tempdir, 'signaling.sock')
+        server = await websockets.unix_serve(standin.handle,
+                                             options.unix_socket)
+        try:
+            return await run_load(options, [StandInAuth()])
+        finally:
+            server.close()
+            await server.wait_closed()
+
+
+def main():
+    parser = ArgumentParser(description='Load generator for the Nextcloud'
+                            ' Talk signaling server')
+    parser.add_argument('--url', default='ws://localhost/spreed',
+                        help='The websocket URL of the signaling server')
+    parser.add_argument('--unix-socket',
+                        help='Connect to the signaling server via the given'
+                        ' Unix socket, for example'
+                        ' /run/nextcloud-signaling-external.sock')
+    parser.add_argument('--insecure', action='store_true',
+                        help='Skip TLS certificate verification')
+    parser.add_argument('--nextcloud', metavar='URL',
+                        help='Base URL of Nextcloud to authenticate against')
+    parser.add_argument('--user', metavar='USER:PASSWORD', action='append',
+                        dest='users',
+                        help='Nextcloud user to authenticate as, can be'
+                        ' specified multiple times to distribute clients'
+                        ' across users')
+    parser.add_argument('--stand-in', action='store_true',
+                        help='Run against a local stand-in signaling server'
+                        ' instead of a real one')
+    parser.add_argument('--room', action='append', dest='rooms',
+                        help='Talk room token to join, can be specified'
+                        ' multiple times to distribute clients across rooms')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help='Maximum number of concurrent session setups')
+    parser.add_argument('--candidates', type=int, default=4,
+                        help='Number of candidates to send to every peer')
+    parser.add_argument('--broadcasts', type=int, default=1,
+                        help='Number of messages to send to the whole room')
+    parser.add_argument('--timeout', type=float, default=60)
+    options = parser.parse_args()
+
+    options.ssl_context = None
+    if options.url.startswith('wss:'):
+        options.ssl_context = ssl.create_default_context()
+        if options.insecure:
+            options.ssl_context.check_hostname = False
+            options.ssl_context.verify_mode = ssl.CERT_NONE
+
+    if options.stand_in:
+        if options.rooms is None:
+            options.rooms = ['loadtest']
+        report = asyncio.run(run_with_stand_in(options))
+    else:
+        if options.nextcloud is None or options.users is None:
+            parser.error('Either --stand-in or --nextcloud and --user are'
+                         ' required.')
+        if options.rooms is None:
+            parser.error('At least one --room is required.')
+        auths = [NextcloudAuth(options.nextcloud, *user.split(':', 1),
+                               verify=not options.insecure)
+                 for user in options.users]
+        report = asyncio.run(run_load(options, auths))
+
+    failures = list(report['failures'])
+    if report['connected'] < report['clients']:
+        failures.append(f'Only {report["connected"]} of {report["clients"]}'
+                        ' clients have been connected.')
+    if report['setup']['errors'] > 0:
+        failures.append(f'{report["setup"]["errors"]} session setups'
+                        f' failed, first error:'
+                        f' {report["setup"]["first_error"]}')
+    write_report(report, failures)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,12 @@
+# Runs the STUN/TURN probe against its local stand-in server, so the probe
+# itself is checked without having to run the whole Talk test.
+{ pkgs }:
+
+pkgs.runCommand "talk-stand-in" {
+  nativeBuildInputs = [ pkgs.python3 ];
+} ''
+  export PYTHONPATH=${import ../loadtools.nix { inherit pkgs; }}
+  mkdir "$out"
+  python3 ${./turn-probe.py} --stand-in --bindings 100 \
+    > "$out/turn-probe.json"
+''
@@ -0,0 +1,482 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import hmac
+import ipaddress
+import os
+import socket
+import struct
+import time
+
+from argparse import ArgumentParser
+from collections import namedtuple
+
+from loadtools import percentiles, write_report
+
+MAGIC_COOKIE = 0x2112A442
+FINGERPRINT_XOR = 0x5354554E
+
+BINDING_REQUEST = 0x0001
+BINDING_SUCCESS = 0x0101
+ALLOCATE_REQUEST = 0x0003
+REFRESH_REQUEST = 0x0004
+CREATE_PERMISSION_REQUEST = 0x0008
+SEND_INDICATION = 0x0016
+
+ATTR_USERNAME = 0x0006
+ATTR_MESSAGE_INTEGRITY = 0x0008
+ATTR_ERROR_CODE = 0x0009
+ATTR_LIFETIME = 0x000D
+ATTR_XOR_PEER_ADDRESS = 0x0012
+ATTR_DATA = 0x0013
+ATTR_REALM = 0x0014
+ATTR_NONCE = 0x0015
+ATTR_XOR_RELAYED_ADDRESS = 0x0016
+ATTR_REQUESTED_TRANSPORT = 0x0019
+ATTR_XOR_MAPPED_ADDRESS = 0x0020
+ATTR_FINGERPRINT = 0x8028
+
+HEADER = struct.Struct('!HHI12s')
+ATTR_HEADER = struct.Struct('!HH')
+# Probe number, sequence number and send time of relayed packets.
+RELAY_PAYLOAD = struct.Struct('!IId')
+RELAY_INTERVAL = 0.02
+
+Message = namedtuple('Message', ['type', 'txid', 'attrs'])
+
+
+class StunError(Exception):
+    def __init__(self, code, reason):
+        super().__init__(f'{code} {reason}')
+        self.code = code
+
+
+def turn_credentials(secret, user='probe', ttl=3600):
+    """
+    Derive credentials for the TURN REST API, which is what coturn expects
+    when using 'use-auth-secret' and what Talk hands out to its clients.
+    """
+    username = f'{int(time.time()) + ttl}:{user}'
+    digest = hmac.new(secret.encode(), username.encode(), hashlib.sha1)
+    return username, base64.b64encode(digest.digest()).decode()
+
+
+def read_secret(path, key='COTURN_STATIC_AUTH_SECRET'):
+    with open(path, 'r') as fp:
+        for line in fp:
+            name, sep, value = line.strip().partition('=')
+            if sep and name == key:
+                return value.strip('"')
+    raise KeyError(f'No {key} found in {path}.')
+
+
+def xor_address(addr, txid):
+    host, port = addr[:2]
+    ip = ipaddress.ip_address(host)
+    xport = port ^ (MAGIC_COOKIE >> 16)
+    mask = struct.pack('!I', MAGIC_COOKIE) + txid
+    packed = bytes(a ^ b for a, b in zip(ip.packed, mask))
+    family = 0x01 if ip.version == 4 else 0x02
+    return struct.pack('!BBH', 0, family, xport) + packed
+
+
+def parse_xor_address(value, txid):
+    family, xport = struct.unpack('!xBH', value[:4])
+    mask = struct.pack('!I', MAGIC_COOKIE) + txid
+    packed = bytes(a ^ b for a, b in zip(value[4:], mask))
+    host = str(ipaddress.ip_address(packed[:4 if family == 0x01 else 16]))
+    return host, xport ^ (MAGIC_COOKIE >> 16)
+
+
+def encode_message(msgtype, txid, attrs, key=None):
+    body = b''
+    for attrtype, value in attrs:
+        padding = b'\0' * (-len(value) % 4)
+        body += ATTR_HEADER.pack(attrtype, len(value)) + value + padding
+
+    if key is not None:
+        header = HEADER.pack(msgtype, len(body) + 24, MAGIC_COOKIE, txid)
+        integrity = hmac.new(key, header + body, hashlib.sha1).digest()
+        body += ATTR_HEADER.pack(ATTR_MESSAGE_INTEGRITY, 20) + integrity
+
+    header = HEADER.pack(msgtype, len(body) + 8, MAGIC_COOKIE, txid)
+    crc = binascii.crc32(header + body) ^ FINGERPRINT_XOR
+    body += ATTR_HEADER.pack(ATTR_FINGERPRINT, 4) + struct.pack('!I', crc)
+    return HEADER.pack(msgtype, len(body), MAGIC_COOKIE, txid) + body
+
+
+def decode_message(data):
+    if len(data) < HEADER.size:
+        return None
+    msgtype, length, cookie, txid = HEADER.unpack_from(data)
+    if cookie != MAGIC_COOKIE or len(data) < HEADER.size + length:
+        return None
+    attrs = {}
+    offset = HEADER.size
+    while offset + ATTR_HEADER.size <= HEADER.size + length:
+        attrtype, attrlen = ATTR_HEADER.unpack_from(data, offset)
+        offset += ATTR_HEADER.size
+        attrs.setdefault(attrtype, data[offset:offset + attrlen])
+        offset += attrlen + (-attrlen % 4)
+    return Message(msgtype, txid, attrs)
+
+
+def raise_for_error(msg):
+    if ATTR_ERROR_CODE not in msg.attrs:
+        return
+    value = msg.attrs[ATTR_ERROR_CODE]
+    code = (value[2] & 0x07) * 100 + value[3]
+    raise StunError(code, value[4:].decode(errors='replace'))
+
+
+class StunProtocol(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        msg = decode_message(data)
+        if msg is None:
+            return
+        future = self.pending.pop(msg.txid, None)
+        if future is not None and not future.done():
+            future.set_result(msg)
+
+    def error_received(self, exc):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(exc)
+        self.pending.clear()
+
+    async def request(self, msgtype, attrs, key=None, txid=None,
+                      retries=5, rto=0.5):
+        if txid is None:
+            txid = os.urandom(12)
+        data = encode_message(msgtype, txid, attrs, key)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[txid] = future
+        try:
+            for attempt in range(retries):
+                self.transport.sendto(data)
+                done, _ = await asyncio.wait([future], timeout=rto)
+                if done:
+                    return future.result()
+                rto *= 2
+        finally:
+            self.pending.pop(txid, None)
+        raise asyncio.TimeoutError('No response from STUN/TURN server.')
+
+
+class StunResponder(asyncio.DatagramProtocol):
+    """
+    Minimal local STUN server, which only answers binding requests.
+    """
+    def __init__(self):
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        msg = decode_message(data)
+        if msg is None or msg.type != BINDING_REQUEST:
+            return
+        attrs = [(ATTR_XOR_MAPPED_ADDRESS, xor_address(addr, msg.txid))]
+        response = encode_message(BINDING_SUCCESS, msg.txid, attrs)
+        self.transport.sendto(response, addr)
+
+
+class RelayPeer(asyncio.DatagramProtocol):
+    """
+    The peer the relayed data is sent to, which records the latency of every
+    packet received from the relayed transport addresses.
+    """
+    def __init__(self):
+        self.latencies = []
+
+    def datagram_received(self, data, addr):
+        if len(data) != RELAY_PAYLOAD.size:
+            return
+        _, _, sent = RELAY_PAYLOAD.unpack(data)
+        self.latencies.append(time.monotonic() - sent)
+
+
+class Results:
+    def __init__(self):
+        self.latencies = []
+        self.errors = []
+        self.mapped = set()
+        self.duration = 0.0
+
+    def report(self, attempts):
+        failures = len(self.errors)
+        result = {
+            'attempts': attempts,
+            'failures': failures,
+            'failure_rate': failures / attempts if attempts else None,
+            'duration': self.duration,
+            'throughput': (attempts - failures) / self.duration
+            if self.duration > 0 else None,
+            'latency': percentiles(self.latencies),
+        }
+        if self.mapped:
+            result['mapped_addresses'] = sorted(self.mapped)
+        if self.errors:
+            result['first_error'] = self.errors[0]
+        return result
+
+
+async def _open_endpoint(server):
+    loop = asyncio.get_running_loop()
+    _, protocol = await loop.create_datagram_endpoint(
+        StunProtocol, remote_addr=server
+    )
+    return protocol
+
+
+async def probe_binding(server, results, semaphore):
+    async with semaphore:
+        protocol = await _open_endpoint(server)
+        try:
+            start = time.monotonic()
+            response = await protocol.request(BINDING_REQUEST, [])
+            raise_for_error(response)
+            if ATTR_XOR_MAPPED_ADDRESS not in response.attrs:
+                raise IOError('No mapped address in binding response.')
+            results.mapped.add(parse_xor_address(
+                response.attrs[ATTR_XOR_MAPPED_ADDRESS], response.txid
+            )[0])
+            results.latencies.append(time.monotonic() - start)
+        except Exception as e:
+            results.errors.append(repr(e))
+        finally:
+            protocol.transport.close()
+
+
+class TurnAuth:
+    """
+    Long-term credentials of a single allocation, along with the realm and
+    nonce most recently handed out by the server.
+    """
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self.realm = None
+        self.nonce = None
+        self.key = None
+
+    def update(self, response):
+        if ATTR_NONCE not in response.attrs:
+            return False
+        self.realm = response.attrs.get(ATTR_REALM, self.realm)
+        self.nonce = response.attrs[ATTR_NONCE]
+        self.key = hashlib.md5(self.username.encode() + b':' + self.realm
+                               + b':' + self.password.encode()).digest()
+        return True
+
+    def attrs(self):
+        if self.nonce is None:
+            return []
+        return [(ATTR_USERNAME, self.username.encode()),
+                (ATTR_REALM, self.realm), (ATTR_NONCE, self.nonce)]
+
+    async def request(self, protocol, msgtype, make_attrs):
+        """
+        Send an authenticated request and retry whenever the server asks for
+        credentials (401) or the nonce has become stale (438).
+
+        The attributes are built by calling make_attrs with the transaction
+        ID, because XOR-encoded addresses depend on it.
+        """
+        for attempt in range(3):
+            txid = os.urandom(12)
+            attrs = make_attrs(txid) + self.attrs()
+            response = await protocol.request(msgtype, attrs, self.key,
+                                              txid=txid)
+            try:
+                raise_for_error(response)
+            except StunError as e:
+                if attempt < 2 and e.code in (401, 438) \
+                   and self.update(response):
+                    continue
+                raise
+            return response
+
+
+async def relay(num, protocol, auth, peer_addr, packets):
+    await auth.request(protocol, CREATE_PERMISSION_REQUEST, lambda txid: [
+        (ATTR_XOR_PEER_ADDRESS, xor_address(peer_addr, txid)),
+    ])
+
+    for seq in range(packets):
+        txid = os.urandom(12)
+        payload = RELAY_PAYLOAD.pack(num, seq, time.monotonic())
+        attrs = [(ATTR_XOR_PEER_ADDRESS, xor_address(peer_addr, txid)),
+                 (ATTR_DATA, payload)]
+        protocol.transport.sendto(encode_message(SEND_INDICATION, txid,
+                                                 attrs))
+        await asyncio.sleep(RELAY_INTERVAL)
+
+
+async def probe_allocation(num, server, credentials, peer_addr, packets,
+                           results, semaphore):
+    async with semaphore:
+        protocol = await _open_endpoint(server)
+        auth = TurnAuth(*credentials)
+        try:
+            start = time.monotonic()
+            response = await auth.request(
+                protocol, ALLOCATE_REQUEST,
+                lambda txid: [(ATTR_REQUESTED_TRANSPORT, bytes([17, 0, 0, 0]))]
+            )
+            if ATTR_XOR_RELAYED_ADDRESS not in response.attrs:
+                raise IOError('No relayed address in allocate response.')
+            results.latencies.append(time.monotonic() - start)
+
+            try:
+                if packets > 0:
+                    await relay(num, protocol, auth, peer_addr, packets)
+            finally:
+                await auth.request(protocol, REFRESH_REQUEST, lambda txid: [
+                    (ATTR_LIFETIME, struct.pack('!I', 0)),
+                ])
+        except Exception as e:
+            results.errors.append(repr(e))
+        finally:
+            protocol.transport.close()
+
+
+def local_address(server):
+    """
+    Return the local address that is used to reach the given server, which
+    is where the relay peer needs to listen so the TURN server can reach it.
+    """
+    family = socket.AF_INET6 if ':' in server[0] else socket.AF_INET
+    with socket.socket(family, socket.SOCK_DGRAM) as sock:
+        sock.connect(server)
+        return sock.getsockname()[0]
+
+
+async def run_probe(options, server):
+    semaphore = asyncio.Semaphore(options.concurrency)
+    host = f'[{server[0]}]' if ':' in server[0] else server[0]
+    report = {'server': f'{host}:{server[1]}'}
+
+    bindings = Results()
+    start = time.monotonic()
+    await asyncio.gather(*(probe_binding(server, bindings, semaphore)
+                           for num in range(options.bindings)))
+    bindings.duration = time.monotonic() - start
+    report['stun'] = bindings.report(options.bindings)
+
+    if options.secret is None:
+        return report
+
+    loop = asyncio.get_running_loop()
+    peer_host = options.peer_address or local_address(server)
+    peer_transport, peer = await loop.create_datagram_endpoint(
+        RelayPeer, local_addr=(peer_host, 0)
+    )
+    try:
+        peer_addr = peer_transport.get_extra_info('sockname')
+        credentials = turn_credentials(options.secret)
+        allocations = Results()
+        start = time.monotonic()
+        await asyncio.gather(*(
+            probe_allocation(num, server, credentials, peer_addr,
+                             options.packets, allocations, semaphore)
+            for num in range(options.allocations)
+        ))
+        allocations.duration = time.monotonic() - start
+        # Give the last relayed packets a chance to arrive.
+        await asyncio.sleep(1)
+    finally:
+        peer_transport.close()
+
+    sent = len(allocations.latencies) * options.packets
+    report['turn'] = allocations.report(options.allocations)
+    report['turn']['relay'] = {
+        'sent': sent,
+        'received': len(peer.latencies),
+        'loss': 1 - len(peer.latencies) / sent if sent else None,
+        'latency': percentiles(peer.latencies),
+    }
+    return report
+
+
+async def run_with_stand_in(options):
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        StunResponder, local_addr=('127.0.0.1', 0)
+    )
+    try:
+        server = transport.get_extra_info('sockname')
+        return await run_probe(options, server)
+    finally:
+        transport.close()
+
+
+def main():
+    parser = ArgumentParser(description='Load and latency probe for STUN and'
+                            ' TURN servers')
+    parser.add_argument('--server', default='localhost:3478',
+                        metavar='HOST:PORT',
+                        help='The STUN/TURN server to probe')
+    parser.add_argument('--secret',
+                        help='The static auth secret of the TURN server,'
+                        ' without it only STUN binding requests are sent')
+    parser.add_argument('--secrets-file', metavar='PATH',
+                        help='Read the secret from the'
+                        ' COTURN_STATIC_AUTH_SECRET variable of the given'
+                        ' environment file, for example'
+                        ' /var/lib/nextcloud-coturn/secrets.env')
+    parser.add_argument('--stand-in', action='store_true',
+                        help='Run against a local stand-in STUN server'
+                        ' instead of a real one, which implies that only'
+                        ' binding requests are sent')
+    parser.add_argument('--peer-address',
+                        help='Local address to receive relayed data on,'
+                        ' defaults to the address used to reach the server')
+    parser.add_argument('--bindings', type=int, default=1000,
+                        help='Number of STUN binding requests')
+    parser.add_argument('--allocations', type=int, default=100,
+                        help='Number of TURN allocations')
+    parser.add_argument('--packets', type=int, default=10,
+                        help='Number of packets to relay per allocation')
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help='Maximum number of concurrent transactions')
+    options = parser.parse_args()
+
+    if options.secrets_file is not None:
+        options.secret = read_secret(options.secrets_file)
+
+    if options.stand_in:
+        options.secret = None
+        report = asyncio.run(run_with_stand_in(options))
+    else:
+        host, _, port = options.server.rpartition(':')
+        addrinfo = socket.getaddrinfo(host.strip('[]'), int(port),
+                                      type=socket.SOCK_DGRAM)
+        server = addrinfo[0][4][:2]
+        report = asyncio.run(run_probe(options, server))
+
+    failures = []
+    for kind in ('stun', 'turn'):
+        result = report.get(kind)
+        if result is not None and result['failures'] > 0:
+            failures.append(f'{result["failures"]} of {result["attempts"]}'
+                            f' {kind.upper()} transactions failed, first'
+                            f' error: {result["first_error"]}')
+    relay = report.get('turn', {}).get('relay')
+    if relay is not None and relay['sent'] > 0 and relay['received'] == 0:
+        failures.append(f'None of the {relay["sent"]} relayed packets have'
+                        ' been received.')
+    write_report(report, failures)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,11 @@
+import fcntl
 import itertools
-import math
-import sys
+import os
+import struct
+import tempfile
+import time
+
+from argparse import ArgumentParser
 
 import numpy
 import imageio
@@ -10,62 +15,277 @@ from systemd.daemon import notify
 from PIL import Image, ImageDraw, ImageFont
 
 PREBUFFER = 10
-WIDTH = 640
-HEIGHT = 480
 DURATION = 500
 FONT_FAMILY = 'Inconsolata'
-TEXT = sys.argv[1]
 
-template = Image.new('RGB', (WIDTH, HEIGHT))
+GRAD_START = numpy.array([255, 0, 0], dtype=numpy.float64)
+GRAD_END = numpy.array([0, 0, 255], dtype=numpy.float64)
+
+# Everything needed to set the output format of a v4l2loopback device, see
+# <linux/videodev2.h> for details.
+V4L2_BUF_TYPE_VIDEO_OUTPUT = 2
+V4L2_FIELD_NONE = 1
+V4L2_COLORSPACE_SMPTE170M = 1
+V4L2_PIX_FMT_YUV420 = int.from_bytes(b'YU12', 'little')
+# struct v4l2_format with an embedded struct v4l2_pix_format on 64 bit
+# platforms, where the union is aligned to 8 bytes and has 200 bytes in size.
+V4L2_FORMAT = struct.Struct('=I4x12I152x')
+VIDIOC_S_FMT = (3 << 30) | (V4L2_FORMAT.size << 16) | (ord('V') << 8) | 5
+
+# ITU-R BT.601 in limited range, which is what FFmpeg uses by default for
+# converting RGB to yuv420p.
+YUV_MATRIX = numpy.array([
+    [65.481, 128.553, 24.966],
+    [-37.797, -74.203, 112.0],
+    [112.0, -93.786, -18.214],
+], dtype=numpy.float32) / 255
+YUV_OFFSET = numpy.array([16, 128, 128], dtype=numpy.float32)
 
-grad_start = [255, 0, 0]
-grad_end = [0, 0, 255]
 
-halfway = min(WIDTH, HEIGHT) / 4
-midx, midy = WIDTH / 2, HEIGHT / 2
+def make_template(text, width, height):
+    template = Image.new('RGB', (width, height))
+    draw = ImageDraw.Draw(template)
+    fonts = fontconfig.query(family=FONT_FAMILY, lang='en')
+    ttf_fonts = [fonts[i].file for i in range(len(fonts))
+                 if fonts[i].fontformat == 'TrueType']
+    font = ImageFont.truetype(ttf_fonts[0], int(height / 8))
+    fwidth, fheight = draw.textsize(text, font=font)
+    draw.text((width / 2 - fwidth / 2, height / 2 - fheight / 2), text,
+              font=font, fill=(255, 255, 255))
+    return numpy.array(template)
 
-draw = ImageDraw.Draw(template)
-fonts = fontconfig.query(family=FONT_FAMILY, lang='en')
-ttf_fonts = [fonts[i].file for i in range(len(fonts))
-             if fonts[i].fontformat == 'TrueType']
-font = ImageFont.truetype(ttf_fonts[0], int(HEIGHT / 8))
-fwidth, fheight = draw.textsize(TEXT, font=font)
-draw.text((midx - fwidth / 2, midy - fheight / 2), TEXT, font=font,
-          fill=(255, 255, 255))
 
-indices = set()
+def make_ring(width, height):
+    """
+    Return the coordinates of all the pixels of the ring along with the
+    index into the gradient palette each pixel has in the very first frame.
+    """
+    halfway = min(width, height) / 4
+    midx, midy = width / 2, height / 2
 
-for x in range(WIDTH):
-    for y in range(HEIGHT):
-        dist_center = math.sqrt((x - midx) ** 2 + (y - midy) ** 2)
-        if halfway * 0.9 < dist_center < halfway * 1.1:
-            indices.add((x, y))
+    ys, xs = numpy.mgrid[0:height, 0:width]
+    dist_center = numpy.hypot(xs - midx, ys - midy)
+    mask = (halfway * 0.9 < dist_center) & (dist_center < halfway * 1.1)
+    ring_ys, ring_xs = numpy.nonzero(mask)
 
-image = numpy.array(template)
+    angle = numpy.abs(numpy.arctan2(ring_ys - midy, ring_xs - midx))
+    offsets = (angle / numpy.pi * DURATION).astype(numpy.intp)
+    return ring_ys, ring_xs, offsets
 
-camvid = imageio.get_writer(
-    '/dev/video0', format='FFMPEG', mode='I', fps=1,
-    input_params=['-re'], output_params=['-f', 'v4l2'],
-    pixelformat='yuv420p', codec='rawvideo'
-)
 
-try:
+def make_palette():
+    """
+    Lookup table for the gradient, which is indexed by the angle of the pixel
+    plus the current frame number modulo DURATION.
+    """
+    phase = 1.0 - numpy.arange(DURATION) / DURATION
+    palette = numpy.outer(phase, GRAD_END) \
+        + numpy.outer(1.0 - phase, GRAD_START)
+    return palette.astype(numpy.uint8)
+
+
+def generate_frames(template, ring, palette):
+    ring_ys, ring_xs, offsets = ring
+    image = template.copy()
     for frame in itertools.cycle(range(DURATION)):
-        for x, y in indices:
-            angle = abs(math.atan2(y - midy, x - midx) / math.pi)
-            angle = 1.0 - (angle + frame / DURATION) % 1.0
-
-            red = grad_end[0] * angle + grad_start[0] * (1.0 - angle)
-            green = grad_end[1] * angle + grad_start[1] * (1.0 - angle)
-            blue = grad_end[2] * angle + grad_start[2] * (1.0 - angle)
-            image[y, x] = (int(red), int(green), int(blue))
-
-        camvid.append_data(image)
-
-        if PREBUFFER is not None:
-            PREBUFFER -= 1
-            if PREBUFFER == 0:
-                notify('READY=1', True)
-                PREBUFFER = None
-finally:
-    camvid.close()
+        image[ring_ys, ring_xs] = palette[(offsets + frame) % DURATION]
+        yield image
+
+
+def notify_after_prebuffer(frames):
+    for num, frame in enumerate(frames, 1):
+        yield frame
+        if num == PREBUFFER:
+            notify('READY=1', True)
+
+
+def rgb_to_yuv420(image, out):
+    height, width = image.shape[:2]
+    yuv = image.astype(numpy.float32) @ YUV_MATRIX.T + YUV_OFFSET
+    chroma = yuv[..., 1:].reshape(height // 2, 2, width // 2, 2, 2)
+    chroma = chroma.mean(axis=(1, 3))
+
+    luma_size = width * height
+    chroma_size = luma_size // 4
+    out[:luma_size] = yuv[..., 0].round().ravel()
+    out[luma_size:luma_size + chroma_size] = chroma[..., 0].round().ravel()
+    out[luma_size + chroma_size:] = chroma[..., 1].round().ravel()
+
+
+def precompute_yuv420_cycle(frames, width, height):
+    """
+    Convert a whole cycle of DURATION frames to planar YUV 4:2:0 once, so
+    that the frames can be written to the device without any conversion.
+
+    The result is backed by a temporary file, so even for high resolutions
+    the kernel is free to page out frames that are not currently in use.
+    """
+    frame_size = width * height * 3 // 2
+    backing = tempfile.TemporaryFile()
+    cycle = numpy.memmap(backing, dtype=numpy.uint8, mode='w+',
+                         shape=(DURATION, frame_size))
+    for buf, image in zip(cycle, itertools.islice(frames, DURATION)):
+        rgb_to_yuv420(image, buf)
+    return cycle
+
+
+def set_v4l2_format(fd, width, height):
+    frame_size = width * height * 3 // 2
+    fmt = bytearray(V4L2_FORMAT.pack(
+        V4L2_BUF_TYPE_VIDEO_OUTPUT, width, height, V4L2_PIX_FMT_YUV420,
+        V4L2_FIELD_NONE, width, frame_size, V4L2_COLORSPACE_SMPTE170M,
+        0, 0, 0, 0, 0
+    ))
+    fcntl.ioctl(fd, VIDIOC_S_FMT, fmt)
+
+
+class Camera:
+    """
+    A single v4l2loopback device, which gets the frames of the shared cycle
+    with its own text layer put on top.
+
+    The text layer is stored as the offsets and values of all the bytes in
+    the YUV 4:2:0 frame that differ from the text-less background, so the
+    only per-device work is a copy of the frame and a small scatter.
+    """
+    def __init__(self, device, text, width, height, background):
+        self.device = device
+        self.text = text
+        self.width = width
+        self.height = height
+
+        overlay = numpy.empty_like(background)
+        rgb_to_yuv420(make_template(text, width, height), overlay)
+        self.text_offsets = numpy.flatnonzero(overlay != background)
+        self.text_values = overlay[self.text_offsets]
+
+        self.buf = numpy.empty_like(background)
+        self.frames_written = 0
+        self.fd = None
+
+    def open(self):
+        self.fd = os.open(self.device, os.O_WRONLY)
+        set_v4l2_format(self.fd, self.width, self.height)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def write(self, frame):
+        numpy.copyto(self.buf, frame)
+        self.buf[self.text_offsets] = self.text_values
+        os.write(self.fd, self.buf)
+        self.frames_written += 1
+
+
+class ReadyAccounting:
+    """
+    Keep track of which cameras have been prebuffered, report the progress
+    via the systemd status and only signal readiness once all are ready.
+    """
+    def __init__(self, cameras):
+        self.pending = list(cameras)
+        self.total = len(self.pending)
+
+    def update(self):
+        if not self.pending:
+            return
+
+        ready = [cam for cam in self.pending
+                 if cam.frames_written >= PREBUFFER]
+        if not ready:
+            return
+
+        self.pending = [cam for cam in self.pending if cam not in ready]
+        devices = ', '.join(cam.device for cam in ready)
+        done = self.total - len(self.pending)
+        notify(f'STATUS={done}/{self.total} cameras ready ({devices})', True)
+        if not self.pending:
+            notify('READY=1', True)
+
+
+def write_v4l2(cameras, cycle, fps):
+    accounting = ReadyAccounting(cameras)
+    try:
+        for camera in cameras:
+            camera.open()
+        interval = 1.0 / fps
+        deadline = time.monotonic()
+        for frame in itertools.cycle(cycle):
+            for camera in cameras:
+                camera.write(frame)
+            accounting.update()
+            deadline += interval
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+    finally:
+        for camera in cameras:
+            camera.close()
+
+
+def write_ffmpeg(device, frames, fps):
+    camvid = imageio.get_writer(
+        device, format='FFMPEG', mode='I', fps=fps,
+        input_params=['-re'], output_params=['-f', 'v4l2'],
+        pixelformat='yuv420p', codec='rawvideo'
+    )
+    try:
+        for image in notify_after_prebuffer(frames):
+            camvid.append_data(image)
+    finally:
+        camvid.close()
+
+
+def main():
+    parser = ArgumentParser(description='Fake camera for WebRTC tests')
+    parser.add_argument('--device', action='append', dest='devices',
+                        help='The v4l2loopback device to write to, which'
+                        ' can be specified once for every label and'
+                        ' defaults to /dev/video0, /dev/video1, ...')
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--fps', type=int, default=1)
+    parser.add_argument('--direct', action='store_true',
+                        help='Write precomputed YUV 4:2:0 frames directly to'
+                        ' the v4l2loopback device instead of piping RGB'
+                        ' frames through FFmpeg')
+    parser.add_argument('texts', nargs='+', metavar='text')
+    options = parser.parse_args()
+
+    devices = options.devices
+    if devices is None:
+        devices = [f'/dev/video{num}' for num in range(len(options.texts))]
+    elif len(devices) != len(options.texts):
+        parser.error('The number of devices must match the number of texts.')
+
+    if options.direct and (options.width % 2 or options.height % 2):
+        parser.error('Width and height must be even for YUV 4:2:0 output.')
+
+    if not options.direct and len(devices) > 1:
+        parser.error('Multiple devices are only supported with --direct.')
+
+    width, height = options.width, options.height
+    ring = make_ring(width, height)
+    palette = make_palette()
+
+    if options.direct:
+        # All cameras share the same text-less cycle and only differ in the
+        # text layer, which is applied right before writing each frame.
+        black = numpy.zeros((height, width, 3), dtype=numpy.uint8)
+        background = numpy.empty(width * height * 3 // 2, dtype=numpy.uint8)
+        rgb_to_yuv420(black, background)
+        cameras = [Camera(device, text, width, height, background)
+                   for device, text in zip(devices, options.texts)]
+        frames = generate_frames(black, ring, palette)
+        cycle = precompute_yuv420_cycle(frames, width, height)
+        write_v4l2(cameras, cycle, options.fps)
+    else:
+        template = make_template(options.texts[0], width, height)
+        frames = generate_frames(template, ring, palette)
+        write_ffmpeg(devices[0], frames, options.fps)
+
+
+if __name__ == '__main__':
+    main()
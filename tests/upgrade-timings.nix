@@ -0,0 +1,89 @@
+import ./make-test.nix (pkgs: let
+  # Apps which are available for all of the major versions below, so their
+  # upgrade timings can be compared across hops.
+  apps = [ "calendar" "contacts" "deck" "polls" "tasks" ];
+
+  seedUsers = 20;
+  seedFilesPerUser = 50;
+
+in {
+  name = "nextcloud-upgrade-timings";
+
+  machine = { lib, pkgs, ... }: {
+    nextcloud.enable = true;
+    nextcloud.domain = "localhost";
+    nextcloud.majorVersion = lib.mkDefault 19;
+    nextcloud.apps = lib.genAttrs apps (lib.const { enable = true; });
+
+    # No libeatmydata for PostgreSQL here, since we want to measure the
+    # migrations with the same disk syncs as on a real deployment.
+    services.nginx.enable = true;
+    services.postgresql.enable = true;
+
+    virtualisation.memorySize = 1024;
+    virtualisation.diskSize = 2048;
+
+    environment.systemPackages = lib.singleton (pkgs.writeScriptBin
+      "nextcloud-upgrade-timings" ''
+        #!${pkgs.stdenv.shell}
+        exec ${lib.escapeShellArg pkgs.python3.interpreter} \
+          ${lib.escapeShellArg "${./upgrade-timings.py}"} "$@"
+      '');
+
+    nesting.clone = [
+      { nextcloud.majorVersion = 20; }
+      { nextcloud.majorVersion = 21; }
+    ];
+  };
+
+  testScript = { nodes, ... }: let
+    inherit (nodes.machine.config.system.build) toplevel;
+    getChild = num: "${toplevel}/fine-tune/child-${toString num}";
+
+    upgradeTo = num: from: to: ''
+      with subtest('upgrade from ${toString from} to ${toString to}'):
+        machine.succeed('${getChild num}/bin/switch-to-configuration test >&2')
+        machine.start_job('nextcloud.service')
+        machine.wait_for_unit('nextcloud.service')
+        report = machine.succeed(
+          'nextcloud-upgrade-timings --from ${toString from}'
+          ' --to ${toString to}'
+        )
+        hops.append(json.loads(report))
+    '';
+
+  in ''
+    # fmt: off
+    import json
+    import os
+    from pathlib import Path
+
+    machine.wait_for_unit('multi-user.target')
+    machine.start_job('nextcloud.service')
+    machine.wait_for_unit('nextcloud.service')
+
+    with subtest('seed database'):
+      machine.succeed('head -c 65536 /dev/urandom > /tmp/seed.bin')
+      for num in range(${toString seedUsers}):
+        user = f'seeduser{num}'
+        password = f'Seed-Password-{num}-For-Upgrade'
+        machine.succeed(
+          f'OC_PASS={password} nextcloud-occ user:add'
+          f' --password-from-env {user} >&2'
+        )
+        machine.succeed(
+          f'for i in $(seq ${toString seedFilesPerUser}); do'
+          f' curl -sSf -u {user}:{password} -T /tmp/seed.bin'
+          f' "http://localhost/remote.php/dav/files/{user}/seed-$i.bin";'
+          ' done'
+        )
+
+    hops = []
+
+    ${upgradeTo 1 19 20}
+    ${upgradeTo 2 20 21}
+
+    report = json.dumps({'hops': hops}, indent=2)
+    (Path(os.environ['out']) / 'upgrade-timings.json').write_text(report)
+  '';
+})
@@ -0,0 +1,166 @@
+import json
+import re
+import subprocess
+import sys
+
+from argparse import ArgumentParser
+
+RE_ANSI = re.compile(r'\x1b\[[0-9;]*m')
+RE_APP_START = re.compile(r'^Updating <(?P<app>[^>]+)> \.\.\.$')
+RE_APP_END = re.compile(r'^Updated <(?P<app>[^>]+)> to (?P<version>\S+)$')
+RE_REPAIR_STEP = re.compile(r'^Repair step: (?P<name>.+)$')
+
+# Pairs of lines printed by "occ upgrade", which enclose a phase we want to
+# measure the duration of.
+PHASES = {
+    'maintenance': ('Turned on maintenance mode',
+                    'Turned off maintenance mode'),
+    'database': ('Updating database schema', 'Updated database'),
+    'code-integrity': ('Starting code integrity check...',
+                       'Finished code integrity check'),
+}
+
+
+def get_invocation_id(unit):
+    cmd = ['systemctl', 'show', '--property=InvocationID', '--value', unit]
+    result = subprocess.run(cmd, capture_output=True, check=True)
+    invocation = result.stdout.strip().decode()
+    if not invocation:
+        raise SystemExit(f'Unit {unit} has not been run yet.')
+    return invocation
+
+
+def read_journal(unit):
+    """
+    Read the output of the last run of the given unit from the journal.
+
+    Every line written to stdout by the unit is a separate journal entry,
+    which has a timestamp with microsecond resolution, so we don't need any
+    timestamps in the output of "occ upgrade" itself.
+    """
+    match = '_SYSTEMD_INVOCATION_ID=' + get_invocation_id(unit)
+    cmd = ['journalctl', '--output=json', '--no-pager', match]
+    result = subprocess.run(cmd, capture_output=True, check=True)
+    return result.stdout.decode().splitlines()
+
+
+def parse_entries(lines):
+    entries = []
+    for line in lines:
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        message = entry.get('MESSAGE')
+        if message is None:
+            continue
+        # Messages that are not valid UTF-8 are represented as byte arrays.
+        if isinstance(message, list):
+            message = bytes(message).decode(errors='replace')
+        timestamp = int(entry['__MONOTONIC_TIMESTAMP']) / 1000000
+        entries.append((timestamp, RE_ANSI.sub('', message).strip()))
+    return entries
+
+
+def find_phase(entries, start, end):
+    started = None
+    for timestamp, message in entries:
+        if started is None and message == start:
+            started = timestamp
+        elif started is not None and message == end:
+            return timestamp - started
+    return None
+
+
+def analyze(entries):
+    """
+    Turn the timestamped output lines of "occ upgrade -v" into timings.
+
+    Every app upgrade is enclosed by "Updating <app> ..." and "Updated <app>
+    to version", which includes running the migrations of the app. Repair
+    steps (which is where Nextcloud runs its data migrations) are only
+    printed when they start, so they last until the next line is printed.
+    """
+    result = {
+        'total': entries[-1][0] - entries[0][0] if entries else 0,
+        'phases': {name: find_phase(entries, start, end)
+                   for name, (start, end) in PHASES.items()},
+        'apps': {},
+        'repair_steps': [],
+        'messages': [],
+    }
+
+    app_starts = {}
+    for num, (timestamp, message) in enumerate(entries):
+        nexttime = entries[num + 1][0] if num + 1 < len(entries) \
+            else timestamp
+
+        match = RE_APP_START.match(message)
+        if match is not None:
+            app_starts[match.group('app')] = timestamp
+            continue
+
+        match = RE_APP_END.match(message)
+        if match is not None and match.group('app') in app_starts:
+            appid = match.group('app')
+            result['apps'][appid] = {
+                'version': match.group('version'),
+                'duration': timestamp - app_starts.pop(appid),
+            }
+            continue
+
+        match = RE_REPAIR_STEP.match(message)
+        if match is not None:
+            result['repair_steps'].append({
+                'name': match.group('name'),
+                'duration': nexttime - timestamp,
+            })
+            continue
+
+        if message.startswith(('Repair warning:', 'Repair error:',
+                               'Update failed')):
+            result['messages'].append(message)
+
+    # Apps that started but never finished upgrading are reported as well,
+    # because it's where the upgrade took too long or failed.
+    for appid, started in app_starts.items():
+        result['apps'][appid] = {'version': None,
+                                 'duration': entries[-1][0] - started}
+
+    slowest = sorted(result['repair_steps'], key=lambda s: s['duration'],
+                     reverse=True)
+    result['slowest_repair_steps'] = [s['name'] for s in slowest[:10]]
+    return result
+
+
+def main():
+    parser = ArgumentParser(description='Extract the duration of repair'
+                            ' steps and app upgrades from the output of the'
+                            ' last run of "occ upgrade"')
+    parser.add_argument('--unit', default='nextcloud-upgrade.service',
+                        help='The systemd unit running "occ upgrade -v"')
+    parser.add_argument('--input', metavar='FILE',
+                        help='Read the output of "journalctl --output=json"'
+                        ' from the given file (or "-" for stdin) instead of'
+                        ' querying the journal for the given unit')
+    parser.add_argument('--from', dest='from_version', metavar='VERSION',
+                        help='Version the upgrade started from')
+    parser.add_argument('--to', dest='to_version', metavar='VERSION',
+                        help='Version the upgrade ended with')
+    options = parser.parse_args()
+
+    if options.input == '-':
+        lines = sys.stdin.read().splitlines()
+    elif options.input is not None:
+        with open(options.input, 'r') as fp:
+            lines = fp.read().splitlines()
+    else:
+        lines = read_journal(options.unit)
+
+    report = {'from': options.from_version, 'to': options.to_version}
+    report.update(analyze(parse_entries(lines)))
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -94,6 +94,9 @@ import ./make-test.nix ({ pkgs, ... }: {
 
   in ''
     # fmt: off
+    import os
+    from pathlib import Path
+
     machine.wait_for_unit('multi-user.target')
     machine.start_job('nextcloud.service')
     machine.wait_for_unit('nextcloud.service')
@@ -109,5 +112,12 @@ import ./make-test.nix ({ pkgs, ... }: {
   in ''
     with subtest('${lib.escape ["\\" "'"] desc}'):
       machine.succeed('python3 -m doctest ${testFile}')
-  '') tests);
+  '') tests) + ''
+    with subtest('benchmark endpoint latencies'):
+      report = machine.succeed(
+        'PYTHONPATH=${import ./loadtools.nix { inherit pkgs; }}'
+        ' python3 ${./http-bench.py} --requests 200 --concurrency 8'
+      )
+      (Path(os.environ['out']) / 'http-bench.json').write_text(report)
+  '';
 })
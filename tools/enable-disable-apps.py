@@ -1,76 +1,196 @@
 import json
 import subprocess
-import sys
 
-from typing import Dict, List, Any
-
-NEWSTATE: Dict[str, Dict[str, Any]] = json.load(open(sys.argv[1], 'r'))
-OCC_CMD: List[str] = sys.argv[2:]
-
-
-def get_appconfig() -> Dict[str, Any]:
-    cmd = OCC_CMD + ['config:list', '--private', '--output=json']
-    return json.loads(subprocess.check_output(cmd))['apps']
-
-
-def set_appconfig(appid: str, key: str, value: str) -> None:
-    args = ['config:app:set', appid, key, '--value=' + value]
-    subprocess.check_call(OCC_CMD + args)
-
-
-def get_applist() -> Dict[str, Any]:
-    cmd = OCC_CMD + ['app:list', '--output=json']
-    return json.loads(subprocess.check_output(cmd))
-
-
-def enable_apps(appids: List[str]) -> None:
-    subprocess.check_call(OCC_CMD + ['app:enable', '--'] + appids)
-
-
-def disable_apps(appids: List[str]) -> None:
-    subprocess.check_call(OCC_CMD + ['app:disable', '--'] + appids)
-
-
-def enable_app_with_groups(appid: str, groups: List[str]) -> None:
-    groupargs = [arg for group in groups for arg in ['-g', group]]
-    subprocess.check_call(OCC_CMD + ['app:enable'] + groupargs + [appid])
-
-
-oldconfig = get_appconfig()
-oldstate = get_applist()
-
-if 'enable' in NEWSTATE:
-    newenabled = set(NEWSTATE['enable'].keys()) \
-               - set(oldstate['enabled'].keys())
-
-    to_enable = []
-    for appid in newenabled:
-        groups = NEWSTATE['enable'][appid]
-        if groups is not None:
-            enable_app_with_groups(appid, groups)
-        else:
-            to_enable.append(appid)
-
-    if to_enable:
-        enable_apps(to_enable)
-
-    for appid, cfg in NEWSTATE.get('appconf', {}).items():
-        oldcfg = oldconfig.get(appid, {})
-        for key, val in cfg.items():
-            oldval = oldcfg.get(key)
-            if oldval is not None and oldval == val:
-                continue
-            set_appconfig(appid, key, val)
-
-newdisabled = set(NEWSTATE['disable']) \
-            - set(oldstate['disabled'].keys())
-
-to_disable = []
-for appid in newdisabled:
-    if appid not in oldstate['enabled'] and \
-       appid not in oldstate['disabled']:
-        continue
-    to_disable.append(appid)
-
-if to_disable:
-    disable_apps(to_disable)
+from argparse import ArgumentParser, REMAINDER
+from typing import Dict, List, Any, Set, Tuple, NamedTuple
+
+AppConfig = Dict[str, Dict[str, Any]]
+
+
+class AppState(NamedTuple):
+    enabled: Set[str]
+    disabled: Set[str]
+
+
+class Occ:
+    """
+    Reads and changes the app state solely via occ, which means that every
+    read operation needs to go through PHP.
+    """
+    def __init__(self, cmd: List[str]):
+        self.cmd = cmd
+
+    def get_appconfig(self, appids: List[str]) -> AppConfig:
+        cmd = self.cmd + ['config:list', '--private', '--output=json']
+        apps = json.loads(subprocess.check_output(cmd))['apps']
+        return {appid: apps[appid] for appid in appids if appid in apps}
+
+    def get_appstate(self) -> AppState:
+        cmd = self.cmd + ['app:list', '--output=json']
+        applist = json.loads(subprocess.check_output(cmd))
+        return AppState(set(applist['enabled'].keys()),
+                        set(applist['disabled'].keys()))
+
+    def set_appconfig(self, appid: str, key: str, value: str) -> None:
+        args = ['config:app:set', appid, key, '--value=' + value]
+        subprocess.check_call(self.cmd + args)
+
+    def enable_apps(self, appids: List[str]) -> None:
+        subprocess.check_call(self.cmd + ['app:enable', '--'] + appids)
+
+    def disable_apps(self, appids: List[str]) -> None:
+        subprocess.check_call(self.cmd + ['app:disable', '--'] + appids)
+
+    def enable_app_with_groups(self, appid: str, groups: List[str]) -> None:
+        groupargs = [arg for group in groups for arg in ['-g', group]]
+        subprocess.check_call(self.cmd + ['app:enable'] + groupargs + [appid])
+
+
+class DatabaseOcc(Occ):
+    """
+    Reads the app state directly from the appconfig table of the database
+    and only uses occ for actually changing state.
+
+    The connection can be any DB-API 2.0 connection, so for example SQLite
+    can be used as a stand-in for PostgreSQL:
+
+    >>> import sqlite3
+    >>> conn = sqlite3.connect(':memory:')
+    >>> _ = conn.execute('CREATE TABLE oc_appconfig (appid VARCHAR(32),'
+    ...                  ' configkey VARCHAR(64), configvalue TEXT,'
+    ...                  ' PRIMARY KEY (appid, configkey))')
+    >>> _ = conn.executemany('INSERT INTO oc_appconfig VALUES (?, ?, ?)', [
+    ...     ('files', 'enabled', 'yes'),
+    ...     ('spreed', 'enabled', '["admin"]'),
+    ...     ('spreed', 'stun_servers', '["localhost:3478"]'),
+    ...     ('spreed', 'installed_version', '10.0.0'),
+    ...     ('news', 'enabled', 'no'),
+    ...     ('news', 'foo', 'bar'),
+    ... ])
+    >>> occ = DatabaseOcc([], conn, 'qmark')
+    >>> state = occ.get_appstate()
+    >>> sorted(state.enabled), sorted(state.disabled)
+    (['files', 'spreed'], ['news'])
+    >>> config = occ.get_appconfig(['spreed', 'unknown'])
+    >>> list(config.keys())
+    ['spreed']
+    >>> config['spreed']['stun_servers']
+    '["localhost:3478"]'
+    >>> len(config['spreed'])
+    3
+    >>> occ.get_appconfig([])
+    {}
+    """
+    def __init__(self, cmd: List[str], conn: Any, paramstyle: str,
+                 table_prefix: str = 'oc_'):
+        super().__init__(cmd)
+        self.conn = conn
+        self.paramstyle = paramstyle
+        self.table = table_prefix + 'appconfig'
+
+    def _placeholders(self, amount: int) -> str:
+        placeholder = '?' if self.paramstyle == 'qmark' else '%s'
+        return ', '.join([placeholder] * amount)
+
+    def _query(self, query: str, *args: str) -> List[Tuple[str, ...]]:
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(query, args)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def get_appconfig(self, appids: List[str]) -> AppConfig:
+        if not appids:
+            return {}
+        query = f'SELECT appid, configkey, configvalue FROM {self.table}' \
+                f' WHERE appid IN ({self._placeholders(len(appids))})'
+        result: AppConfig = {}
+        for appid, key, value in self._query(query, *appids):
+            result.setdefault(appid, {})[key] = value
+        return result
+
+    def get_appstate(self) -> AppState:
+        query = f'SELECT appid, configvalue FROM {self.table}' \
+                f' WHERE configkey = {self._placeholders(1)}'
+        state = AppState(set(), set())
+        for appid, value in self._query(query, 'enabled'):
+            if value == 'no':
+                state.disabled.add(appid)
+            else:
+                state.enabled.add(appid)
+        return state
+
+
+def reconcile(newstate: Dict[str, Dict[str, Any]], occ: Occ) -> None:
+    appconf = newstate.get('appconf', {})
+    oldconfig = occ.get_appconfig(list(appconf.keys()))
+    oldstate = occ.get_appstate()
+
+    if 'enable' in newstate:
+        newenabled = set(newstate['enable'].keys()) - oldstate.enabled
+
+        to_enable = []
+        for appid in newenabled:
+            groups = newstate['enable'][appid]
+            if groups is not None:
+                occ.enable_app_with_groups(appid, groups)
+            else:
+                to_enable.append(appid)
+
+        if to_enable:
+            occ.enable_apps(to_enable)
+
+        for appid, cfg in appconf.items():
+            oldcfg = oldconfig.get(appid, {})
+            for key, val in cfg.items():
+                oldval = oldcfg.get(key)
+                if oldval is not None and oldval == val:
+                    continue
+                occ.set_appconfig(appid, key, val)
+
+    newdisabled = set(newstate['disable']) - oldstate.disabled
+
+    to_disable = []
+    for appid in newdisabled:
+        if appid not in oldstate.enabled:
+            continue
+        to_disable.append(appid)
+
+    if to_disable:
+        occ.disable_apps(to_disable)
+
+
+def main() -> None:
+    parser = ArgumentParser(description='Enable/disable Nextcloud apps')
+    parser.add_argument('--db-host', help='Read the current app state'
+                        ' directly from the PostgreSQL database using the'
+                        ' given socket directory instead of using occ')
+    parser.add_argument('--db-name', default='nextcloud')
+    parser.add_argument('--db-user', default='nextcloud')
+    parser.add_argument('--db-table-prefix', default='oc_')
+    parser.add_argument('statefile')
+    parser.add_argument('occ', nargs=REMAINDER)
+    options = parser.parse_args()
+
+    with open(options.statefile, 'r') as fp:
+        newstate = json.load(fp)
+
+    if options.db_host is None:
+        reconcile(newstate, Occ(options.occ))
+        return
+
+    import psycopg2
+    conn = psycopg2.connect(host=options.db_host, dbname=options.db_name,
+                            user=options.db_user)
+    try:
+        conn.set_session(readonly=True, autocommit=True)
+        occ = DatabaseOcc(options.occ, conn, psycopg2.paramstyle,
+                          options.db_table_prefix)
+        reconcile(newstate, occ)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,7 @@ pkgs.python3Packages.buildPythonApplication {
   };
 
   propagatedBuildInputs = [
+    pkgs.python3Packages.cryptography
     pkgs.python3Packages.defusedxml
     pkgs.python3Packages.pyopenssl
     pkgs.python3Packages.requests
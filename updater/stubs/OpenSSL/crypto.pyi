@@ -1,5 +1,7 @@
 from typing import Union, NewType
 
+from cryptography.x509 import Certificate
+
 FileType = NewType('FileType', int)
 StoreFlagType = NewType('StoreFlagType', int)
 
@@ -12,7 +14,7 @@ class CRL:
 
 
 class X509:
-    pass
+    def to_cryptography(self) -> Certificate: ...
 
 
 class X509StoreFlags:
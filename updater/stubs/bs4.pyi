@@ -8,5 +8,5 @@ class Tag:
 
 
 class BeautifulSoup(Tag):
-    def __init__(self, markup: Union[IO, str] = ...,
+    def __init__(self, markup: Union[IO, str, bytes] = ...,
                  features: Optional[Union[str, List[str]]] = ...): ...
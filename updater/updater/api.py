@@ -4,7 +4,7 @@ import requests
 import re
 import unicodedata
 
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Set
 from pathlib import Path
 from semantic_version import Spec, Version
 from bs4 import BeautifulSoup
@@ -12,9 +12,9 @@ from urllib.parse import urljoin
 from xml.sax import saxutils
 
 from .progress import download_pbar
-from .types import Nextcloud, AppId, App, ExternalApp, ReleaseInfo, \
-                   SignatureInfo, Sha256
-from . import nix
+from .types import Nextcloud, AppId, App, InternalApp, ExternalApp, \
+                   ReleaseInfo, SignatureInfo, Sha256
+from . import nix, recording
 
 RE_NEXTCLOUD_RELEASE = re.compile(r'^nextcloud-([0-9.]+)\.tar\.bz2$')
 RE_NEXTCLOUD_INTERNAL_VERSION_DIGIT = re.compile(
@@ -22,24 +22,38 @@ RE_NEXTCLOUD_INTERNAL_VERSION_DIGIT = re.compile(
     re.MULTILINE
 )
 
-__all__ = ['clean_meta', 'upgrade']
+# The number of parallel connections used for downloading the server tarball.
+NEXTCLOUD_DOWNLOAD_CONNECTIONS = 8
+
+__all__ = ['clean_meta', 'get_unknown_apps', 'upgrade']
 
 
 def _hash_zip(url: str, sha256: Sha256) -> Sha256:
     fname: str = url.rsplit('/', 1)[-1]
     assert len(fname) > 0
 
-    data = download_pbar(url, desc='Downloading ' + url)
+    # The tarball is hashed while it's being downloaded, so we don't need to
+    # go over the whole file again afterwards.
+    hasher = hashlib.sha256()
+    data = download_pbar(url, desc='Downloading ' + url,
+                         on_chunk=hasher.update,
+                         connections=NEXTCLOUD_DOWNLOAD_CONNECTIONS)
 
-    assert hashlib.sha256(data).hexdigest() == sha256
-    return nix.hash_zip_content(fname, data)
+    assert hasher.hexdigest() == sha256
+    # The tarball has been verified, so its contents can be added to the store
+    # as the output of fetchzip, which avoids downloading it a second time.
+    return nix.hash_zip_content(fname, data, nix.FETCHZIP_NAME, sha256)
 
 
 def _get_nextcloud_versions() -> Dict[Version, str]:
     baseurl = 'https://download.nextcloud.com/server/releases/'
-    response = requests.get(baseurl)
-    response.raise_for_status()
-    soup = BeautifulSoup(response.text, 'html.parser')
+
+    def fetch() -> bytes:
+        response = requests.get(baseurl)
+        response.raise_for_status()
+        return response.content
+
+    soup = BeautifulSoup(recording.fetch(baseurl, fetch), 'html.parser')
     versions: Dict[Version, str] = {}
     for link in soup.find_all("a"):
         match = RE_NEXTCLOUD_RELEASE.match(link["href"])
@@ -170,7 +184,35 @@ def _get_external_apps(
     return apps
 
 
-def upgrade(major: int, info: ReleaseInfo) -> ReleaseInfo:
+def _upgrade_apps(info: ReleaseInfo,
+                  only: Optional[Set[AppId]]) -> ReleaseInfo:
+    external = _get_external_apps(info.nextcloud, info.constraints)
+    apps: Dict[AppId, App]
+    if only is None:
+        apps = {appid: app for appid, app in info.apps.items()
+                if isinstance(app, InternalApp)}
+        apps.update(external)
+    else:
+        apps = dict(info.apps)
+        apps.update({appid: app for appid, app in external.items()
+                     if appid in only})
+    return ReleaseInfo(info.nextcloud, apps, info.constraints)
+
+
+def upgrade(major: int, info: ReleaseInfo, apps_only: bool = False,
+            only: Optional[Set[AppId]] = None) -> ReleaseInfo:
+    """
+    Upgrade Nextcloud and its apps to the latest versions available for the
+    given major version.
+
+    If apps_only is True or specific apps are selected via only, Nextcloud
+    itself is kept at the current version, so neither the release listing
+    nor the internal apps need to be fetched again. With only, all the apps
+    except the selected ones are kept as well.
+    """
+    if info.nextcloud.version is not None and (apps_only or only is not None):
+        return _upgrade_apps(info, only)
+
     old_nc_version = info.nextcloud.version
     nextcloud = _fetch_latest_nextcloud(major, old_nc_version)
     if nextcloud is None:
@@ -179,3 +221,26 @@ def upgrade(major: int, info: ReleaseInfo) -> ReleaseInfo:
         apps = _get_external_apps(nextcloud, info.constraints)
         apps.update(nix.get_internal_apps(nextcloud))
     return ReleaseInfo(nextcloud, apps, info.constraints)
+
+
+def get_unknown_apps(only: Set[AppId],
+                     infos: List[ReleaseInfo]) -> Set[AppId]:
+    """
+    Return the apps selected via the only argument of upgrade() which are not
+    an external app in any of the given upgraded release infos, which are
+    either misspelled or internal apps that can't be upgraded on their own.
+
+    >>> nextcloud = Nextcloud(None, '', Sha256(''))
+    >>> internal = InternalApp('Files', '', '', [], True, True)
+    >>> external = ExternalApp('Deck', Version('1.0.0'), '', '', None, [],
+    ...                        'https://example.org/deck.tar.gz', Sha256(''))
+    >>> infos = [ReleaseInfo(nextcloud, {AppId('files'): internal}, {}),
+    ...          ReleaseInfo(nextcloud, {AppId('deck'): external}, {})]
+    >>> sorted(get_unknown_apps({AppId('deck'), AppId('files'),
+    ...                          AppId('dekc')}, infos))
+    ['dekc', 'files']
+    """
+    available = {appid for info in infos
+                 for appid, app in info.apps.items()
+                 if isinstance(app, ExternalApp)}
+    return only - available
@@ -1,13 +1,19 @@
 import base64
+import hashlib
 import re
 import string
 
 from pathlib import Path
 from functools import lru_cache
+from typing import Tuple
 from OpenSSL import crypto
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.hazmat.primitives.asymmetric.utils import Prehashed
 
 from .progress import download_pbar
-from .nix import hash_zip_content
+from .nix import FETCHZIP_NAME, hash_zip_content
 from .types import App, InternalApp, SignatureInfo, Sha256
 
 PEM_RE = re.compile('-----BEGIN .+?-----\r?\n.+?\r?\n-----END .+?-----\r?\n?',
@@ -36,24 +42,59 @@ def verify_cert(ncpath: Path, certdata: str) -> crypto.X509:
 
 
 @lru_cache(maxsize=None)
-def _cached_fetch(name: str, download_url: str) -> bytes:
+def _cached_fetch(name: str, download_url: str) -> Tuple[bytes, bytes]:
+    # The SHA-512 digest for verifying the signature is calculated while
+    # downloading, so we don't need another pass over the data afterwards.
+    hasher = hashlib.sha512()
     # Apps do have a signature, so even if the remote's cert check fails, we
     # can still proceed.
-    return download_pbar(download_url, verify=False,
-                         desc=f'Downloading app {name}')
+    data = download_pbar(download_url, verify=False,
+                         desc=f'Downloading app {name}',
+                         on_chunk=hasher.update)
+    return data, hasher.digest()
 
 
-def fetch_app_hash(ncpath: Path, app: App) -> Sha256:
+def verify_signature(cert: crypto.X509, sig: bytes, data: bytes,
+                     digest: bytes) -> None:
+    """
+    Verify the signature against the precomputed SHA-512 digest of the data.
+
+    If verification fails, the slow path via crypto.verify() is used so that
+    the error is exactly the same as if the data would have been verified
+    directly.
+    """
+    key = cert.to_cryptography().public_key()
+    if not isinstance(key, rsa.RSAPublicKey):
+        crypto.verify(cert, sig, data, 'sha512')
+        return
+
+    try:
+        key.verify(sig, digest, padding.PKCS1v15(),
+                   Prehashed(hashes.SHA512()))
+    except InvalidSignature:
+        crypto.verify(cert, sig, data, 'sha512')
+        raise
+
+
+def fetch_app_hash(ncpath: Path, app: App, seed_store: bool = False) -> Sha256:
+    """
+    Download and verify the given app and return the hash of its contents.
+
+    If seed_store is True, the unpacked app is added to the store as the
+    output of the corresponding fetchzip call, so that building the package
+    afterwards doesn't need to download the app again.
+    """
     if isinstance(app, InternalApp):
         raise ValueError("Can't download internal app {repr(app)}.")
     if not isinstance(app.hash_or_sig, SignatureInfo):
         raise ValueError("Signature information missing for {repr(appdata)}")
 
     cert = verify_cert(ncpath, app.hash_or_sig.certificate)
-    data = _cached_fetch(app.name, app.download_url)
+    data, digest = _cached_fetch(app.name, app.download_url)
     sig = base64.b64decode(app.hash_or_sig.signature)
-    crypto.verify(cert, sig, data, 'sha512')
+    verify_signature(cert, sig, data, digest)
     fname_base = app.download_url.rsplit('/', 1)[-1].rsplit('?', 1)[0]
     valid_chars = string.ascii_letters + string.digits + "._-"
     safename: str = ''.join(c for c in fname_base if c in valid_chars)
-    return hash_zip_content(safename.lstrip('.'), data)
+    store_name = FETCHZIP_NAME if seed_store else None
+    return hash_zip_content(safename.lstrip('.'), data, store_name)
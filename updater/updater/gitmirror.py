@@ -0,0 +1,123 @@
+import hashlib
+import os
+import re
+import subprocess
+
+from pathlib import Path
+from subprocess import CalledProcessError
+from tempfile import TemporaryFile
+from typing import List
+
+from .types import Sha256
+from .nix import hash_tar_as_nar
+
+__all__ = ['DEFAULT_CACHE_DIR', 'GitMirror']
+
+DEFAULT_CACHE_DIR = Path(
+    os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')
+) / 'avonc-updater' / 'git'
+
+
+class GitMirror:
+    """
+    A bare repository mirroring a remote repository, which only fetches the
+    objects that are not yet present locally whenever a new revision is
+    requested.
+
+    Every fetched commit is pinned by a ref in the mirror, so that it is not
+    garbage collected and is offered to the remote during negotiation, which
+    keeps subsequent fetches incremental even without fetching any branches.
+
+    >>> import tempfile
+    >>> tempdir = tempfile.TemporaryDirectory()
+    >>> upstream = Path(tempdir.name) / 'upstream'
+    >>> def git(*args: str) -> str:
+    ...     cmd = ['git', '-C', str(upstream), '-c', 'user.name=test',
+    ...            '-c', 'user.email=test@example.org', *args]
+    ...     return subprocess.run(cmd, check=True, capture_output=True
+    ...                           ).stdout.decode().strip()
+    >>> _ = subprocess.run(['git', 'init', '-q', str(upstream)], check=True)
+    >>> _ = (upstream / 'hello').write_text('hello\\n')
+    >>> _ = git('add', 'hello')
+    >>> _ = git('commit', '-q', '-m', 'initial', '--date=@0')
+    >>> rev = git('rev-parse', 'HEAD')
+
+    >>> mirror = GitMirror(upstream.as_uri(), Path(tempdir.name) / 'cache')
+    >>> mirror.has_commit(rev)
+    False
+    >>> mirror.resolve(rev) == rev
+    True
+    >>> mirror.has_commit(rev)
+    True
+    >>> mirror.nar_hash(rev)
+    '1pgyz59p65wd11vfxp3vi673ijwjfg7i4ynlqlsgzvg9dvh67dpj'
+    >>> tempdir.cleanup()
+    """
+    def __init__(self, url: str, cachedir: Path = DEFAULT_CACHE_DIR):
+        self.url = url
+        basename = re.sub(r'[^A-Za-z0-9._-]', '_', url.rstrip('/')
+                          .rsplit('/', 1)[-1])
+        urlhash = hashlib.sha256(url.encode()).hexdigest()[:16]
+        self.path = cachedir / f'{urlhash}-{basename}'
+
+    def _git(self, *args: str) -> bytes:
+        cmd = ['git', '--git-dir', str(self.path), *args]
+        return subprocess.run(cmd, capture_output=True, check=True).stdout
+
+    def _init(self) -> None:
+        if self.path.exists():
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._git('init', '--quiet', '--bare')
+        self._git('remote', 'add', 'origin', self.url)
+
+    def has_commit(self, rev: str) -> bool:
+        if not self.path.exists():
+            return False
+        try:
+            self._git('cat-file', '-e', f'{rev}^{{commit}}')
+        except CalledProcessError:
+            return False
+        return True
+
+    def _fetch(self, refspecs: List[str]) -> None:
+        self._git('fetch', '--quiet', '--no-tags', 'origin', *refspecs)
+
+    def resolve(self, rev: str) -> str:
+        """
+        Fetch the given revision if necessary and return its commit hash.
+
+        Commit hashes that are already present in the mirror don't need any
+        network access, while everything else, like branch or tag names, is
+        fetched from the remote to get its current commit.
+        """
+        self._init()
+        if re.fullmatch(r'[0-9a-f]{40}', rev) is None \
+           or not self.has_commit(rev):
+            try:
+                self._fetch([rev])
+            except CalledProcessError:
+                # Not all remotes allow fetching arbitrary commits, so fall
+                # back to fetching all branches and tags.
+                self._fetch(['+refs/heads/*:refs/heads/*',
+                             '+refs/tags/*:refs/tags/*'])
+            else:
+                rev = 'FETCH_HEAD'
+        commit = self._git('rev-parse', '--verify', f'{rev}^{{commit}}') \
+            .strip().decode()
+        self._git('update-ref', f'refs/pinned/{commit}', commit)
+        return commit
+
+    def nar_hash(self, rev: str) -> Sha256:
+        """
+        Calculate the hash of the tree of the given revision, which is the
+        same as the one of fetchFromGitHub, since GitHub generates its
+        tarballs using "git archive" as well.
+        """
+        commit = self.resolve(rev)
+        with TemporaryFile() as fp:
+            cmd = ['git', '--git-dir', str(self.path), 'archive',
+                   '--format=tar', commit]
+            subprocess.run(cmd, stdout=fp, check=True)
+            fp.seek(0)
+            return hash_tar_as_nar(fp)
@@ -1,9 +1,9 @@
 import json
 import sys
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, Namespace
 from pathlib import Path
-from typing import Dict, Any, Optional, Tuple
+from typing import Dict, Any, List, Optional, Set, Tuple
 from semantic_version import Version, Spec
 from subprocess import run
 from tqdm import tqdm
@@ -11,12 +11,14 @@ from tqdm import tqdm
 from .types import AppId, App, InternalApp, ExternalApp, Nextcloud, \
                    ReleaseInfo, Sha256, SignatureInfo, AppChanges
 from .app import fetch_app_hash
-from . import api, nix
+from . import api, nix, recording
 from .diff import ReleaseDiff
+from .metadata import MetadataStore
 from .changelogs import pretty_print_changes
 
 
-def import_data(data: Dict[str, Any], major: int) -> ReleaseInfo:
+def import_data(data: Dict[str, Any], major: int,
+                metadata: Optional[MetadataStore] = None) -> ReleaseInfo:
     nextcloud_data = data.get('nextcloud', {})
     version_str = nextcloud_data.get('version')
     version = None if version_str is None else Version.coerce(version_str)
@@ -29,6 +31,8 @@ def import_data(data: Dict[str, Any], major: int) -> ReleaseInfo:
     apps: Dict[AppId, App] = {}
     for appid, attrs in app_data.items():
         meta = attrs.get('meta', {})
+        if metadata is not None:
+            meta = metadata.resolve(meta)
 
         name = meta.get('name')
         if name is None:
@@ -60,7 +64,8 @@ def import_data(data: Dict[str, Any], major: int) -> ReleaseInfo:
     return ReleaseInfo(nextcloud, apps, constraints)
 
 
-def export_data(info: ReleaseInfo) -> Dict[str, Any]:
+def export_data(info: ReleaseInfo,
+                metadata: Optional[MetadataStore] = None) -> Dict[str, Any]:
     apps: Dict[str, Any] = {}
 
     for appid, app in info.apps.items():
@@ -99,24 +104,32 @@ def export_data(info: ReleaseInfo) -> Dict[str, Any]:
         },
         'applications': apps,
     }
+    if metadata is not None:
+        for attrs in apps.values():
+            attrs['meta'] = metadata.intern(attrs['meta'])
     if info.constraints:
         result['constraints'] = {appid: str(spec)
                                  for appid, spec in info.constraints.items()}
     return result
 
 
-def update_major(major: int, info_file: Path) -> Optional[
-    Tuple[str, AppChanges]
-]:
+def load_release_info(major: int, info_file: Path,
+                      metadata: Optional[MetadataStore] = None
+                      ) -> ReleaseInfo:
     current_state: Dict[str, Any]
     try:
         with open(info_file, 'r') as current:
             current_state = json.load(current)
     except FileNotFoundError:
         current_state = {}
+    return import_data(current_state, major, metadata)
+
 
-    old: ReleaseInfo = import_data(current_state, major)
-    new: ReleaseInfo = api.upgrade(major, old)
+def update_major(major: int, old: ReleaseInfo, new: ReleaseInfo,
+                 metadata: Optional[MetadataStore] = None,
+                 seed_store: bool = False) -> Optional[
+    Tuple[str, AppChanges]
+]:
     diff = ReleaseDiff(old, new)
 
     has_differences = diff.has_differences()
@@ -139,7 +152,7 @@ def update_major(major: int, info_file: Path) -> Optional[
                f' major version {major}'
         for appid, app in tqdm(to_download.items(), desc=desc, ascii=True):
             try:
-                sha256: Sha256 = fetch_app_hash(ncpath, app)
+                sha256: Sha256 = fetch_app_hash(ncpath, app, seed_store)
             except Exception as e:
                 msg = f"Exception occured while fetching {appid}: {e}"
                 tqdm.write(msg, file=sys.stderr)
@@ -155,7 +168,8 @@ def update_major(major: int, info_file: Path) -> Optional[
 
             joined.apps[appid] = app._replace(hash_or_sig=sha256)
 
-    result = json.dumps(export_data(joined), indent=2, sort_keys=True) + "\n"
+    exported = export_data(joined, metadata)
+    result = json.dumps(exported, indent=2, sort_keys=True) + "\n"
     return result, diff.get_changes()
 
 
@@ -171,15 +185,15 @@ def prepare_commit_message(subject: str, message: str) -> None:
         fp.write(subject + "\n\n" + message)
 
 
-def main() -> None:
-    parser = ArgumentParser(description='Update Nextcloud Server and Apps')
-    parser.add_argument('-g', '--git-commit', action='store_true',
-                        help='Prepare Git commit message')
-    options = parser.parse_args()
-
+def update_all(options: Namespace) -> None:
     basedir: Path = Path.cwd() / 'packages'
+    metadata_file: Path = basedir / 'metadata.json'
+    metadata = MetadataStore.load(metadata_file)
+    info_files: List[Path] = []
+    releases: Dict[int, Tuple[Path, ReleaseInfo, ReleaseInfo]] = {}
     outfiles: Dict[Path, str] = {}
     changeset: Dict[int, AppChanges] = {}
+    only = None if options.only is None else set(options.only)
     for subdir in basedir.iterdir():
         dirname = subdir.name
         if not dirname.isdigit():
@@ -191,10 +205,28 @@ def main() -> None:
             continue
 
         info_file: Path = packagedir / 'upstream.json'
-        info = update_major(int(dirname), info_file)
+        info_files.append(info_file)
+        major = int(dirname)
+        old = load_release_info(major, info_file, metadata)
+        new = api.upgrade(major, old, options.apps_only, only)
+        releases[major] = (info_file, old, new)
+
+    # Check the selected apps before fetching any of them, so a misspelled
+    # app ID doesn't result in silently updating nothing.
+    if only is not None:
+        unknown = api.get_unknown_apps(
+            only, [new for _, _, new in releases.values()]
+        )
+        if unknown:
+            sys.exit('Unknown or internal apps given via --only: '
+                     + ', '.join(sorted(unknown)))
+
+    for major, (info_file, old, new) in releases.items():
+        info = update_major(major, old, new, metadata,
+                            options.seed_store)
         if info is not None:
             outfiles[info_file] = info[0]
-            changeset[int(dirname)] = info[1]
+            changeset[major] = info[1]
 
     pretty_printed: str = pretty_print_changes(changeset)
 
@@ -202,9 +234,51 @@ def main() -> None:
         with open(path, 'w') as newstate:
             newstate.write(data)
 
+    # Only keep the metadata that's still referenced by any major version.
+    used: Set[str] = set()
+    for info_file in info_files:
+        if info_file.exists():
+            with open(info_file, 'r') as fp:
+                used |= metadata.references(json.load(fp))
+    metadata.prune(used)
+    metadata.save(metadata_file)
+
     if pretty_printed:
         tqdm.write("\n" + pretty_printed, file=sys.stderr)
         if options.git_commit:
             prepare_commit_message('Update all Nextcloud apps', pretty_printed)
             tqdm.write('Commit message prepared, please run "git commit"'
                        ' after staging files.', file=sys.stderr)
+
+
+def main() -> None:
+    parser = ArgumentParser(description='Update Nextcloud Server and Apps')
+    parser.add_argument('-g', '--git-commit', action='store_true',
+                        help='Prepare Git commit message')
+    parser.add_argument('--apps-only', action='store_true',
+                        help='Only update apps and keep the current version'
+                        ' of Nextcloud')
+    parser.add_argument('--only', metavar='APPID', nargs='+', type=AppId,
+                        help='Only update the given apps, which implies'
+                        ' --apps-only')
+    parser.add_argument('--seed-store', action='store_true',
+                        help='Add the verified and unpacked apps to the Nix'
+                        ' store, so that the next build does not need to'
+                        ' download them again')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--record', metavar='DIR', type=Path,
+                       help='Record all HTTP responses and results of Nix'
+                       ' commands into the given directory')
+    group.add_argument('--replay', metavar='DIR', type=Path,
+                       help='Replay a run previously recorded via --record'
+                       ' without accessing the network')
+    options = parser.parse_args()
+
+    if options.record is not None:
+        with recording.recording(options.record, replay=False):
+            update_all(options)
+    elif options.replay is not None:
+        with recording.recording(options.replay, replay=True):
+            update_all(options)
+    else:
+        update_all(options)
@@ -0,0 +1,77 @@
+import hashlib
+import json
+
+from pathlib import Path
+from typing import Any, Dict, Optional, Set, Union
+
+Meta = Dict[str, Any]
+
+__all__ = ['MetadataStore']
+
+
+class MetadataStore:
+    """
+    Content-addressed store for the metadata of apps, which is shared by
+    the upstream.json files of all major versions.
+
+    Metadata with the same contents is only stored once and every major
+    version only references it by its key:
+
+    >>> store = MetadataStore()
+    >>> key = store.intern({'name': 'Foo', 'licenses': ['agpl']})
+    >>> key
+    '19f1b6a18cc4b83b'
+    >>> store.intern({'licenses': ['agpl'], 'name': 'Foo'}) == key
+    True
+    >>> store.resolve(key) is store.resolve({'name': 'Foo',
+    ...                                      'licenses': ['agpl']})
+    True
+    >>> store.references({'applications': {'foo': {'meta': key},
+    ...                                    'bar': {'meta': {'name': 'Bar'}}}})
+    {'19f1b6a18cc4b83b'}
+    >>> store.prune(set())
+    >>> store.entries
+    {}
+    """
+    def __init__(self, entries: Optional[Dict[str, Meta]] = None):
+        self.entries: Dict[str, Meta] = dict(entries or {})
+
+    @classmethod
+    def load(cls, path: Path) -> 'MetadataStore':
+        try:
+            with open(path, 'r') as fp:
+                return cls(json.load(fp))
+        except FileNotFoundError:
+            return cls()
+
+    def save(self, path: Path) -> None:
+        with open(path, 'w') as fp:
+            json.dump(self.entries, fp, indent=2, sort_keys=True)
+            fp.write("\n")
+
+    @staticmethod
+    def _key(meta: Meta) -> str:
+        data = json.dumps(meta, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+    def intern(self, meta: Meta) -> str:
+        key = self._key(meta)
+        self.entries.setdefault(key, meta)
+        return key
+
+    def resolve(self, meta: Union[str, Meta]) -> Meta:
+        """
+        Return the metadata for the given key, while metadata that is still
+        stored inline is interned, so all copies share the same object.
+        """
+        if isinstance(meta, str):
+            return self.entries[meta]
+        return self.entries[self.intern(meta)]
+
+    def references(self, data: Dict[str, Any]) -> Set[str]:
+        return {app['meta'] for app in data.get('applications', {}).values()
+                if isinstance(app.get('meta'), str)}
+
+    def prune(self, used: Set[str]) -> None:
+        self.entries = {key: meta for key, meta in self.entries.items()
+                        if key in used}
@@ -1,27 +1,164 @@
+import hashlib
 import json
 import subprocess
+import tarfile
 import tempfile
 
 from pathlib import Path
 from defusedxml import ElementTree as ET
-from typing import Dict, List
+from typing import IO, Dict, List, Optional, Union
 
 from .types import Nextcloud, AppId, InternalApp, Sha256
+from . import recording
+
+# The default name of the store paths produced by fetchzip.
+FETCHZIP_NAME = 'source'
+
+NIX_BASE32_CHARS = '0123456789abcdfghijklmnpqrsvwxyz'
+
+# Everything that is read from the Nextcloud store path, which is needed to
+# replay recorded runs without the store path being available.
+NEXTCLOUD_STORE_FILES = [
+    'version.php',
+    'core/shipped.json',
+    'apps/*/appinfo/info.xml',
+    'resources/codesigning/root.*',
+]
+
+
+def to_nix_base32(digest: bytes) -> str:
+    """
+    Encode a digest in the base32 variant used by Nix:
+
+    >>> to_nix_base32(hashlib.sha256(b'').digest())
+    '0mdqa9w1p6cmli6976v4wi0sw9r4p5prkj7lzfd1877wk11c9c73'
+    """
+    result = ''
+    for n in reversed(range((len(digest) * 8 + 4) // 5)):
+        byte, bit = divmod(n * 5, 8)
+        value = digest[byte] >> bit
+        if byte + 1 < len(digest):
+            value |= digest[byte + 1] << (8 - bit)
+        result += NIX_BASE32_CHARS[value & 0x1f]
+    return result
 
 
-def hash_zip_content(fname: str, data: bytes) -> Sha256:
-    with tempfile.TemporaryDirectory() as tempdir:
-        destpath = Path(tempdir) / fname
-        open(destpath, 'wb').write(data)
-        cmd = ['nix-prefetch-url', '--type', 'sha256', '--unpack',
-               destpath.as_uri()]
-        result = subprocess.run(cmd, capture_output=True, check=True).stdout
-        ziphash = result.strip().decode()
-        return Sha256(ziphash)
+# A node of a file system tree as needed for serialising it as a NAR, which
+# is either the contents of a file along with its executable bit, the target
+# of a symlink or the entries of a directory.
+NarNode = Union[Dict[str, 'NarNode'], 'NarFile', str]
+
+
+class NarFile:
+    def __init__(self, fileobj: Optional[IO[bytes]], executable: bool):
+        self.fileobj = fileobj
+        self.executable = executable
+
+
+def _nar_str(data: Union[str, bytes]) -> bytes:
+    raw = data.encode() if isinstance(data, str) else data
+    padding = b'\0' * (-len(raw) % 8)
+    return len(raw).to_bytes(8, 'little') + raw + padding
+
+
+def _nar_node(node: NarNode) -> bytes:
+    if isinstance(node, str):
+        return b''.join(map(_nar_str, ['(', 'type', 'symlink',
+                                       'target', node, ')']))
+    elif isinstance(node, NarFile):
+        data = b'' if node.fileobj is None else node.fileobj.read()
+        flags = ['executable', ''] if node.executable else []
+        return b''.join(map(_nar_str, ['(', 'type', 'regular', *flags,
+                                       'contents'])) \
+            + _nar_str(data) + _nar_str(')')
+    result = b''.join(map(_nar_str, ['(', 'type', 'directory']))
+    for name in sorted(node, key=lambda name: name.encode()):
+        result += b''.join(map(_nar_str, ['entry', '(', 'name', name,
+                                          'node']))
+        result += _nar_node(node[name]) + _nar_str(')')
+    return result + _nar_str(')')
+
+
+def hash_tar_as_nar(fileobj: IO[bytes]) -> Sha256:
+    """
+    Calculate the hash Nix would use for the contents of an unpacked tar
+    archive, like for example the one of a fixed-output derivation produced
+    by fetchzip with stripRoot disabled.
+
+    >>> import io
+    >>> buf = io.BytesIO()
+    >>> with tarfile.open(fileobj=buf, mode='w') as tar:
+    ...     info = tarfile.TarInfo('hello')
+    ...     info.size = 6
+    ...     tar.addfile(info, io.BytesIO(b'hello\\n'))
+    >>> hash_tar_as_nar(io.BytesIO(buf.getvalue()))
+    '1pgyz59p65wd11vfxp3vi673ijwjfg7i4ynlqlsgzvg9dvh67dpj'
+    """
+    root: Dict[str, NarNode] = {}
+    with tarfile.open(fileobj=fileobj, mode='r:*') as tar:
+        for member in tar:
+            parts = Path(member.name).parts
+            if not parts:
+                continue
+            *parents, name = parts
+            directory = root
+            for parent in parents:
+                subdir = directory.setdefault(parent, {})
+                assert isinstance(subdir, dict)
+                directory = subdir
+            if member.isdir():
+                directory.setdefault(name, {})
+            elif member.issym():
+                directory[name] = member.linkname
+            elif member.isfile():
+                directory[name] = NarFile(tar.extractfile(member),
+                                          bool(member.mode & 0o100))
+        nar = _nar_str('nix-archive-1') + _nar_node(root)
+    return Sha256(to_nix_base32(hashlib.sha256(nar).digest()))
+
+
+def hash_zip_content(fname: str, data: bytes,
+                     store_name: Optional[str] = None,
+                     sha256: Optional[str] = None) -> Sha256:
+    """
+    Calculate the hash of the unpacked contents of the given archive.
+
+    As a side effect, nix-prefetch-url adds the unpacked contents to the
+    store. If store_name is given, it's used as the name of the resulting
+    store path, so with FETCHZIP_NAME the path is the same as the output of
+    fetchzip for this archive, which then doesn't need to download the
+    archive again.
+
+    If the SHA-256 digest of the archive is already known, it can be passed
+    via sha256 to avoid hashing the data again.
+    """
+    name = fname if store_name is None else store_name
+    if sha256 is None:
+        sha256 = hashlib.sha256(data).hexdigest()
+
+    def prefetch() -> bytes:
+        with tempfile.TemporaryDirectory() as tempdir:
+            destpath = Path(tempdir) / fname
+            open(destpath, 'wb').write(data)
+            cmd = ['nix-prefetch-url', '--type', 'sha256', '--unpack',
+                   '--name', name, destpath.as_uri()]
+            return subprocess.run(cmd, capture_output=True,
+                                  check=True).stdout
+
+    key = ['nix-prefetch-url', '--type', 'sha256', '--unpack', fname, sha256]
+    ziphash = recording.command(key, prefetch).strip().decode()
+    return Sha256(ziphash)
 
 
 def get_nextcloud_store_path(nextcloud: Nextcloud) -> Path:
+    """
+    Get the store path of the unpacked Nextcloud release, which usually
+    already exists since hash_zip_content() added it to the store when
+    hashing the downloaded tarball, so nix-build doesn't need to download
+    anything.
+    """
     data: Dict[str, str] = {
+        'name': FETCHZIP_NAME,
         'url': nextcloud.download_url,
         'sha256': nextcloud.sha256
     }
@@ -29,14 +166,13 @@ def get_nextcloud_store_path(nextcloud: Nextcloud) -> Path:
     { attrs }:
 
     (import <nixpkgs> {}).fetchzip {
-        inherit (builtins.fromJSON attrs) url sha256;
+        inherit (builtins.fromJSON attrs) name url sha256;
     }
     '''
 
     cmd = ['nix-build', '--no-out-link', '--builders', '',
            '-E', expr, '--argstr', 'attrs', json.dumps(data)]
-    result = subprocess.run(cmd, capture_output=True, check=True).stdout
-    return Path(result.strip().decode())
+    return recording.store_path(cmd, NEXTCLOUD_STORE_FILES)
 
 
 def get_internal_apps(nextcloud: Nextcloud) -> Dict[AppId, InternalApp]:
@@ -69,23 +205,21 @@ def get_internal_apps(nextcloud: Nextcloud) -> Dict[AppId, InternalApp]:
     return result
 
 
-def fetch_from_github(owner: str, repo: str, rev: str) -> Sha256:
-    data: Dict[str, str] = {
-        'owner': owner,
-        'repo': repo,
-        'rev': rev,
-        'sha256': '0' * 52,
-    }
-    expr = b'''
-    { attrs }: {
-        src = (import <nixpkgs> {}).fetchFromGitHub (builtins.fromJSON attrs);
-    }
-    '''
-    with tempfile.NamedTemporaryFile() as exprfile:
-        exprfile.write(expr)
-        exprfile.flush()
-        cmd = ['nix-prefetch-url', exprfile.name,
-               '--argstr', 'attrs', json.dumps(data),
-               '-A', 'src']
-        result = subprocess.run(cmd, capture_output=True, check=True).stdout
-        return Sha256(result.strip().decode())
+def fetch_from_github(owner: str, repo: str, rev: str,
+                      cachedir: Optional[Path] = None) -> Sha256:
+    """
+    Get the hash for fetchFromGitHub of the given revision.
+
+    Instead of downloading the full tarball of every revision, the repository
+    is mirrored in the given cache directory, so that only new objects need
+    to be fetched and the hash is calculated from the mirror.
+    """
+    from .gitmirror import DEFAULT_CACHE_DIR, GitMirror
+    url = f'https://github.com/{owner}/{repo}.git'
+    mirror = GitMirror(url, cachedir or DEFAULT_CACHE_DIR)
+
+    def prefetch() -> bytes:
+        return mirror.nar_hash(rev).encode()
+
+    key = ['fetchFromGitHub', owner, repo, rev]
+    return Sha256(recording.command(key, prefetch).decode())
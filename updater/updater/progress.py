@@ -1,31 +1,257 @@
+import re
 import requests
+import threading
 import warnings
 
-from typing import Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional, cast
 from tqdm import tqdm
 from urllib3.exceptions import InsecureRequestWarning
 
+from . import recording
+
+# The size of the byte ranges requested by segmented downloads.
+SEGMENT_SIZE = 8 * 1024 * 1024
+
+RE_CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
 
 def download_pbar(url: str, verify: bool = True,
-                  desc: Optional[str] = None) -> bytes:
+                  desc: Optional[str] = None,
+                  on_chunk: Optional[Callable[[bytes], None]] = None,
+                  connections: int = 1) -> bytes:
+    """
+    Download the given URL while showing a progress bar.
+
+    If on_chunk is given, it's called with every chunk as soon as it has
+    been received, which allows processing the data while the download is
+    still running.
+
+    With more than one connection, the file is downloaded in segments via
+    range requests using the given number of connections in parallel, unless
+    the server doesn't support range requests.
+    """
+    streamed = False
+
+    def download() -> bytes:
+        nonlocal streamed
+        streamed = True
+        if connections > 1:
+            return _download_segmented(url, verify, desc, on_chunk,
+                                       connections)
+        return _download(url, verify, desc, on_chunk)
+
+    data = recording.fetch(url, download)
+    # The data might come from a recording, so nothing has been streamed.
+    if on_chunk is not None and not streamed:
+        on_chunk(data)
+    return data
+
+
+@contextmanager
+def _ignore_insecure_warnings(verify: bool) -> Iterator[None]:
     if verify:
-        response = requests.get(url, stream=True)
-    else:
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", InsecureRequestWarning)
-            response = requests.get(url, stream=True, verify=False)
+        yield
+        return
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", InsecureRequestWarning)
+        yield
 
+
+def _download(url: str, verify: bool, desc: Optional[str],
+              on_chunk: Optional[Callable[[bytes], None]]) -> bytes:
+    with _ignore_insecure_warnings(verify):
+        response = requests.get(url, stream=True, verify=verify)
     response.raise_for_status()
+    return _read_response(response, desc, on_chunk)
+
 
+def _read_response(response: requests.Response, desc: Optional[str],
+                   on_chunk: Optional[Callable[[bytes], None]]) -> bytes:
     file_size = int(response.headers.get('content-length', 0))
-    buf: bytes = b''
+    buf = bytearray()
     pbar: tqdm = tqdm(desc=desc, total=file_size, unit='B', unit_scale=True,
                       ascii=True)
     chunksize: int = max(file_size // 100, 8192)
     try:
         for data in response.iter_content(chunk_size=chunksize):
             buf += data
+            if on_chunk is not None:
+                on_chunk(data)
             pbar.update(len(data))
     finally:
         pbar.close()
-    return buf
+    return bytes(buf)
+
+
+class _SegmentedDownload:
+    """
+    State of a download that fetches byte ranges of SEGMENT_SIZE over
+    several connections into a preallocated buffer.
+
+    Every worker thread has its own session, so connections are reused for
+    all the segments fetched by that thread.
+    """
+    def __init__(self, url: str, verify: bool):
+        self.url = url
+        self.verify = verify
+        self.local = threading.local()
+        self.cond = threading.Condition()
+        self.error: Optional[BaseException] = None
+        self.aborted = False
+        self.size = 0
+        self.buf = bytearray()
+        self.filled: List[int] = []
+
+    @property
+    def session(self) -> requests.Session:
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.verify = self.verify
+            self.local.session = session
+        return session
+
+    def get_range(self, num: int) -> requests.Response:
+        start = num * SEGMENT_SIZE
+        end = start + SEGMENT_SIZE if self.size == 0 \
+            else min(start + SEGMENT_SIZE, self.size)
+        headers = {'Range': f'bytes={start}-{end - 1}',
+                   'Accept-Encoding': 'identity'}
+        return self.session.get(self.url, headers=headers, stream=True)
+
+    def allocate(self, size: int) -> None:
+        self.size = size
+        self.buf = bytearray(size)
+        self.filled = [0] * ((size + SEGMENT_SIZE - 1) // SEGMENT_SIZE)
+
+    def fetch(self, num: int,
+              response: Optional[requests.Response] = None) -> None:
+        try:
+            self._fetch(num, response)
+        except BaseException as e:
+            with self.cond:
+                self.error = e
+                self.cond.notify()
+            raise
+
+    def _fetch(self, num: int, response: Optional[requests.Response]) -> None:
+        if response is None:
+            response = self.get_range(num)
+        response.raise_for_status()
+        start = num * SEGMENT_SIZE
+        end = min(start + SEGMENT_SIZE, self.size)
+        if _get_total_size(response, start, end) != self.size:
+            raise IOError(f'Invalid response for range {start}-{end - 1}'
+                          f' of {self.url}.')
+
+        view = memoryview(self.buf)
+        offset = start
+        for data in response.iter_content(chunk_size=65536):
+            if self.aborted:
+                return
+            if offset + len(data) > end:
+                raise IOError(f'Too much data for range {start}-{end - 1}'
+                              f' of {self.url}.')
+            view[offset:offset + len(data)] = data
+            offset += len(data)
+            with self.cond:
+                self.filled[num] = offset - start
+                self.cond.notify()
+
+        if offset != end:
+            raise IOError(f'Incomplete data for range {start}-{end - 1}'
+                          f' of {self.url}.')
+
+    def contiguous(self) -> int:
+        """
+        Return the number of bytes from the start that have been received
+        without any gaps in between.
+        """
+        for num, filled in enumerate(self.filled):
+            if filled < min(SEGMENT_SIZE, self.size - num * SEGMENT_SIZE):
+                return num * SEGMENT_SIZE + filled
+        return self.size
+
+    def consume(self, desc: Optional[str],
+                on_chunk: Optional[Callable[[bytes], None]]) -> None:
+        """
+        Wait until all segments are downloaded while passing the data to
+        on_chunk in order as soon as there is no gap before it.
+        """
+        pbar: tqdm = tqdm(desc=desc, total=self.size, unit='B',
+                          unit_scale=True, ascii=True)
+        consumed = 0
+        received = 0
+        try:
+            while consumed < self.size:
+                with self.cond:
+                    self.cond.wait_for(lambda: self.error is not None
+                                       or sum(self.filled) != received)
+                    if self.error is not None:
+                        raise self.error
+                    available = self.contiguous()
+                    pbar.update(sum(self.filled) - received)
+                    received = sum(self.filled)
+                if on_chunk is not None and available > consumed:
+                    on_chunk(bytes(self.buf[consumed:available]))
+                consumed = available
+        finally:
+            pbar.close()
+
+
+def _get_total_size(response: requests.Response, start: int,
+                    end: int) -> Optional[int]:
+    """
+    Get the total size of the file from the Content-Range header of a
+    partial response, if it matches the requested range.
+    """
+    if response.status_code != 206:
+        return None
+    match = RE_CONTENT_RANGE.match(response.headers.get('content-range', ''))
+    if match is None or int(match.group(1)) != start:
+        return None
+    total = int(match.group(3))
+    if int(match.group(2)) != min(end, total) - 1:
+        return None
+    return total
+
+
+def _download_segmented(url: str, verify: bool, desc: Optional[str],
+                        on_chunk: Optional[Callable[[bytes], None]],
+                        connections: int) -> bytes:
+    download = _SegmentedDownload(url, verify)
+    with _ignore_insecure_warnings(verify), \
+            ThreadPoolExecutor(connections) as executor:
+        # The first segment is requested before knowing the size of the file,
+        # so its response tells us both the size and whether the server
+        # supports range requests at all. If it doesn't, the response
+        # contains the whole file, which is then used as a single stream.
+        first = executor.submit(download.get_range, 0).result()
+        # Empty files have no satisfiable range.
+        if first.status_code == 416:
+            first.close()
+            return _download(url, verify, desc, on_chunk)
+        first.raise_for_status()
+        size = _get_total_size(first, 0, SEGMENT_SIZE)
+        if size is None:
+            if first.status_code == 206:
+                raise IOError(f'Invalid response for first range of {url}.')
+            return _read_response(first, desc, on_chunk)
+
+        download.allocate(size)
+        futures: List[Future[None]] = [
+            executor.submit(download.fetch, 0, first)
+        ] + [executor.submit(download.fetch, num)
+             for num in range(1, len(download.filled))]
+        try:
+            download.consume(desc, on_chunk)
+        except BaseException:
+            download.aborted = True
+            for future in futures:
+                future.cancel()
+            raise
+    # The buffer supports everything done with downloaded data, so it's
+    # returned as-is instead of copying the whole file once more.
+    return cast(bytes, download.buf)
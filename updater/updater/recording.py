@@ -0,0 +1,200 @@
+import hashlib
+import json
+import shutil
+
+from contextlib import contextmanager
+from pathlib import Path
+from subprocess import run as _run
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+__all__ = ['ReplayError', 'Archive', 'recording', 'fetch', 'command',
+           'store_path']
+
+
+class ReplayError(Exception):
+    pass
+
+
+class Archive:
+    """
+    An on-disk archive of network responses and subprocess results.
+
+    Every result is stored under a key in an index, while the actual data is
+    stored in content-addressed blobs, so identical responses are only stored
+    once. Errors are recorded as well, so that a replay fails at the same
+    places as the recorded run:
+
+    >>> import tempfile
+    >>> tempdir = tempfile.TemporaryDirectory()
+    >>> archive = Archive(Path(tempdir.name), replay=False)
+    >>> archive.capture('a', lambda: b'data')
+    b'data'
+    >>> archive.capture('b', lambda: b'data')
+    b'data'
+    >>> def offline() -> bytes:
+    ...     raise IOError('offline')
+    >>> archive.capture('c', offline)
+    Traceback (most recent call last):
+      ...
+    OSError: offline
+    >>> archive.save()
+    >>> len(list((Path(tempdir.name) / 'blobs').iterdir()))
+    1
+
+    >>> replay = Archive(Path(tempdir.name), replay=True)
+    >>> replay.capture('b', offline)
+    b'data'
+    >>> replay.capture('c', offline)
+    Traceback (most recent call last):
+      ...
+    updater.recording.ReplayError: OSError: offline
+    >>> replay.capture('d', offline)
+    Traceback (most recent call last):
+      ...
+    updater.recording.ReplayError: No recorded result for 'd'.
+    >>> tempdir.cleanup()
+    """
+    def __init__(self, path: Path, replay: bool):
+        self.path = path
+        self.replay = replay
+        self.index: Dict[str, Dict[str, Any]] = {}
+        if replay:
+            with open(path / 'index.json', 'r') as fp:
+                self.index = json.load(fp)
+        else:
+            (path / 'blobs').mkdir(parents=True, exist_ok=True)
+
+    def save(self) -> None:
+        if self.replay:
+            return
+        with open(self.path / 'index.json', 'w') as fp:
+            json.dump(self.index, fp, indent=2, sort_keys=True)
+            fp.write("\n")
+
+    def _lookup(self, key: str) -> Dict[str, Any]:
+        entry = self.index.get(key)
+        if entry is None:
+            raise ReplayError(f'No recorded result for {key!r}.')
+        if 'error' in entry:
+            raise ReplayError(entry['error'])
+        return entry
+
+    def capture(self, key: str, func: Callable[[], bytes]) -> bytes:
+        if self.replay:
+            digest = self._lookup(key)['blob']
+            return (self.path / 'blobs' / digest).read_bytes()
+
+        try:
+            data = func()
+        except Exception as e:
+            self.index[key] = {'error': f'{type(e).__name__}: {e}'}
+            raise
+
+        digest = hashlib.sha256(data).hexdigest()
+        blob = self.path / 'blobs' / digest
+        if not blob.exists():
+            blob.write_bytes(data)
+        self.index[key] = {'blob': digest}
+        return data
+
+    def capture_tree(self, key: str, func: Callable[[], Path],
+                     patterns: Sequence[str]) -> Path:
+        """
+        Capture a store path, but only the files matching the given glob
+        patterns, which need to cover everything that's read from the path.
+
+        Store paths are immutable, so the files are only copied the first
+        time a key is captured:
+
+        >>> import tempfile
+        >>> tempdir = tempfile.TemporaryDirectory()
+        >>> storepath = Path(tempdir.name) / 'store'
+        >>> storepath.mkdir()
+        >>> _ = (storepath / 'version.php').write_text('1')
+        >>> archive = Archive(Path(tempdir.name) / 'archive', replay=False)
+        >>> tree = archive.capture_tree('a', lambda: storepath, ['*.php'])
+        >>> tree == storepath
+        True
+        >>> _ = (storepath / 'version.php').write_text('2')
+        >>> _ = archive.capture_tree('a', lambda: storepath, ['*.php'])
+        >>> archive.save()
+
+        >>> replay = Archive(Path(tempdir.name) / 'archive', replay=True)
+        >>> tree = replay.capture_tree('a', lambda: storepath, ['*.php'])
+        >>> (tree / 'version.php').read_text()
+        '1'
+        >>> tempdir.cleanup()
+        """
+        if self.replay:
+            return self.path / 'trees' / self._lookup(key)['tree']
+
+        try:
+            storepath = func()
+        except Exception as e:
+            self.index[key] = {'error': f'{type(e).__name__}: {e}'}
+            raise
+
+        name = hashlib.sha256(key.encode()).hexdigest()
+        if self.index.get(key) == {'tree': name}:
+            return storepath
+
+        dest = self.path / 'trees' / name
+        for pattern in patterns:
+            for path in storepath.glob(pattern):
+                target = dest / path.relative_to(storepath)
+                target.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(path, target)
+        self.index[key] = {'tree': name}
+        return storepath
+
+
+_archive: Optional[Archive] = None
+
+
+@contextmanager
+def recording(path: Path, replay: bool) -> Iterator[Archive]:
+    """
+    Record all network traffic and subprocess results to the archive at the
+    given path or replay them from there if replay is True.
+    """
+    global _archive
+    archive = Archive(path, replay)
+    _archive = archive
+    try:
+        yield archive
+    finally:
+        _archive = None
+        archive.save()
+
+
+def fetch(url: str, func: Callable[[], bytes]) -> bytes:
+    if _archive is None:
+        return func()
+    return _archive.capture(f'GET {url}', func)
+
+
+def command(key: List[str], func: Callable[[], bytes]) -> bytes:
+    """
+    Capture the output of a command run by func, which is identified by the
+    given key. The key needs to be stable across runs, so for example it
+    must not contain names of temporary files.
+    """
+    if _archive is None:
+        return func()
+    return _archive.capture('RUN ' + json.dumps(key), func)
+
+
+def store_path(cmd: List[str], patterns: Sequence[str]) -> Path:
+    """
+    Build a store path using the given command and return it.
+
+    During replay, the store path is substituted by a directory only
+    containing the files matching the given patterns.
+    """
+    def func() -> Path:
+        result = _run(cmd, capture_output=True, check=True).stdout
+        return Path(result.strip().decode())
+
+    if _archive is None:
+        return func()
+    return _archive.capture_tree('BUILD ' + json.dumps(cmd), func, patterns)